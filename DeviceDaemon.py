@@ -21,14 +21,21 @@ import pprint
 import threading
 import time
 import platform
+import json
+from urlparse import urlparse
 
 # requires packages python-daemon and pidfile-0.1.1
 import daemon
 from pidfile import PidFile
 
 from DeviceLib.Device import Device
-from DeviceLib.BluetoothDevice import BluetoothDiscoverDevice, BluetoothDevice
+from DeviceLib.EventLoop import EventLoop
+from DeviceLib.Registry import DeviceRegistry
+from DeviceLib.Checkpoint import StateCheckpoint
+from DeviceLib.EventBus import EventBus, CallbackSink, Event
+from DeviceLib.BluetoothDevice import BluetoothDiscoverDevice, BluetoothDevice, BluetoothProbe
 from DeviceLib.PingDevice import PingDiscoverDevice, PingDevice
+from DeviceLib.ArpDevice import ArpDiscoverDevice
 from DeviceLib.HttpDevice import HttpDiscoverDevice, HttpDevice, HttpRequestHandler
 
 
@@ -145,6 +152,8 @@ class PirMotionDetection(threading.Thread):
         self._timeout = options['timeout']
         self._counter = self._timeout
         self._motion = None
+        self._loop = None
+        self._checkpoint = None
         self._shutdown = False
 
     def motion(self, pin):
@@ -155,102 +164,300 @@ class PirMotionDetection(threading.Thread):
             self._motion = True
             self._callback['motion'](pin)
 
-    def run(self):
+    def tick(self):
 
-        self._logger.info("Pir detection started with timeout of %d seconds ..." % self._timeout)
+        self._counter -= 1
 
-        while not self._shutdown and self._counter > 0:
+        if self._counter == 0:
+            self._counter = self._timeout
+            if self._motion is None or self._motion:
+                self._motion = False
+                self._callback['idle']()
 
-            self._counter -= 1
+    def run(self):
 
-            if self._counter == 0:
-                self._counter = self._timeout
-                if self._motion is None or self._motion:
-                    self._motion = False
-                    self._callback['idle']()
+        self._logger.info("Pir detection started with timeout of %d seconds ..." % self._timeout)
 
+        while not self._shutdown and self._counter > 0:
+            self.tick()
             time.sleep(1)
 
         self._logger.info("Pir detection stopped!")
 
+    def attach(self, loop):
+        """
+        Run the pir timer inside the event loop instead of its own thread
+        """
+        self._logger.info("Pir detection attached to event loop with timeout of %d seconds ..." % self._timeout)
+        self._loop = loop
+        self._loop.call_later(1, self._loop_tick)
+
+    def _loop_tick(self):
+        if self._shutdown:
+            self._logger.info("Pir detection stopped!")
+            return
+        self.tick()
+        self._loop.call_later(1, self._loop_tick)
+
     def shutdown(self):
         self._shutdown = True
 
 
 class Controller():
 
+    # modules with a device state in the snapshot
+    _modules = ['ping', 'bluetooth', 'http']
+
     def callback(self, device):
         assert (isinstance(device, Device))
         self._logger.warn("Generic callback for device [%s]. Check configuration!" % device.key)
 
     def bluetooth_new(self, bt_device):
         assert isinstance(bt_device, BluetoothDevice)
+        self._changed('bluetooth.new', bt_device)
         self._logger.info('Discovered %s bluetooth device [%s] %s' % ("known" if bt_device.known else "unknown",
                                                                       bt_device.address, bt_device.name))
 
     def bluetooth_off(self, bt_device):
         assert isinstance(bt_device, BluetoothDevice)
+        self._changed('bluetooth.off', bt_device)
         self._logger.info('%s bluetooth device disappeared [%s] %s' % ("Known" if bt_device.known else "Unknown",
                                                                        bt_device.address, bt_device.name))
 
     def ping_new(self, ping_device):
         assert isinstance(ping_device, PingDevice)
-        if ping_device.online is None:
-            # device found by the first check after daemon starts
-            self._logger.info('Found ip device [%s] %s' % (ping_device.ip, ping_device.dns))
-        else:
-            self._logger.info("Found new ip device [%s] %s" % (ping_device.ip, ping_device.dns))
+        self._changed('ping.new', ping_device)
+        self._logger.info("Found ip device [%s] %s" % (ping_device.ip, ping_device.dns))
 
     def ping_off(self, ping_device):
         assert isinstance(ping_device, PingDevice)
-        if ping_device.online is None:
-            # device offline during first check after daemon starts
-            self._logger.info('IP device offline [%s] %s' % (ping_device.ip, ping_device.dns))
-        else:
-            self._logger.info('IP device disappeared [%s] %s' % (ping_device.ip, ping_device.dns))
+        self._changed('ping.off', ping_device)
+        self._logger.info('IP device disappeared [%s] %s' % (ping_device.ip, ping_device.dns))
+
+    def ping_batch(self, transitions):
+        found = [t for t in transitions if t.event == 'new']
+        lost = [t for t in transitions if t.event == 'off']
+        self._logger.info("Ping batch: %d ip device(s) found, %d ip device(s) disappeared" % (len(found), len(lost)))
+        for transition in transitions:
+            self._changed('ping.' + transition.event, transition.device)
+            self._logger.debug("%s ip device [%s] %s" % ("Found" if transition.event == 'new' else "Lost",
+                                                        transition.device.ip, transition.device.dns))
 
     def http_zone_changed(self, http_device):
         assert isinstance(http_device, HttpDevice)
         message = "Device %s with serial %s %s zone %s" % \
                   (http_device.name, http_device.serial, "entered" if http_device.update else "left", http_device.zone)
         self._logger.info(message)
+        self._changed('http.update', http_device)
+        self._publish('http.update', http_device)
         return 200, message
 
     def http_get_request(self, request, handler):
         assert isinstance(handler, HttpRequestHandler)
         self._logger.info("Http request: [%s]" % handler.path)
+        path = urlparse(handler.path).path.rstrip('/')
+        if path == '/devices':
+            return self.device_states()
+        if path.startswith('/devices/'):
+            return self.device_states(path[len('/devices/'):])
+        if 'stats' in request:
+            return self.ping_stats(None if request['stats'][0] == 'all' else request['stats'][0])
         return 200, "Path: %s" % handler.path
 
     def pipe_request(self, buffer):
         assert isinstance(buffer, str)
         self._logger.info("Pipe request: [%s]" % buffer)
+        command = buffer.split()
+        if command[0] == 'stats':
+            (response, message) = self.ping_stats(command[1] if len(command) > 1 else None)
+            self._logger.info("Ping statistics: %s" % message)
+
+    def ping_stats(self, device=None):
+        """
+        Round trip time and packet loss statistics of one or all ping devices
+        :return: tuple (response, message) with the statistics as JSON object
+        """
+        if not self._ping['discover']:
+            return 404, "Ping discovery not enabled"
+        stats = self._ping['discover'].stats(device)
+        if device is not None and not stats:
+            return 404, "Unknown ping device [%s]" % device
+        return 200, json.dumps(stats, sort_keys=True)
+
+    def _changed(self, name, device):
+        """
+        Device state change: update the snapshot and the event stream
+        """
+        if self._loop is not None:
+            # the snapshot is only modified by the event loop, like reloads and expiries
+            self._loop.call_soon_threadsafe(self._track, name.split('.')[0], device)
+        else:
+            self._track(name.split('.')[0], device)
+        self._stream(name, device)
+
+    def _stream(self, name, payload=None, data=None):
+        if self._http['discover']:
+            event = Event.create(name, payload, data)
+            self._http['discover'].stream.put(event.name, event.json())
+
+    def _current(self, kind, device):
+        """
+        :return: True, if the device was not removed by a reload or expired meanwhile
+        """
+        discover = {'ping': self._ping, 'bluetooth': self._bluetooth, 'http': self._http}[kind]['discover']
+        if not discover:
+            return False
+        return any(current is device for current in (discover.pings if kind == 'ping' else discover.devices))
+
+    def _module_state(self, kind, device):
+
+        state = device.state()
+        if kind == 'ping':
+            rtt = device.rtt_avg
+            state['rtt'] = round(rtt * 1000, 3) if rtt is not None else None
+        return state
+
+    def _device_state(self, key, modules):
+        """
+        :param modules: dictionary with the state of the device in every module
+        :return: combined device state
+        """
+        state = {'key': key, 'online': None, 'timestamp': None, 'zone': None, 'rtt': None}
+        for kind, module in modules.items():
+            state[kind] = module
+            if module['online'] is not None:
+                state['online'] = state['online'] or module['online']
+            if module['timestamp'] and module['timestamp'] > state['timestamp']:
+                # timestamp 0 for devices not seen yet
+                state['timestamp'] = module['timestamp']
+        if 'http' in modules:
+            state['zone'] = modules['http']['zone']
+        if 'ping' in modules:
+            state['rtt'] = modules['ping']['rtt']
+        return state
+
+    def _track(self, kind, device):
+        """
+        Update the snapshot of the device state endpoints with the state of a
+        changed device. Entries are replaced instead of modified, so readers
+        need no lock.
+        """
+        if not self._current(kind, device):
+            return
+        entry = self._snapshot.get(device.key, {})
+        modules = dict((name, entry[name]) for name in self._modules if name in entry)
+        modules[kind] = self._module_state(kind, device)
+        self._snapshot[device.key] = self._device_state(device.key, modules)
+
+    def device_states(self, key=None):
+        """
+        Current state of one or all devices: online, zone, seconds since last seen and
+        average round trip time in milliseconds, with the state of every subsystem
+        :param key: device key or any identifier, None for all devices
+        :return: tuple (response, message, content type) with the state as JSON object
+        """
+        now = time.time()
+        snapshot = self._snapshot
+        if key is None:
+            states = dict((key, self._aged(state, now)) for key, state in snapshot.items())
+            return 200, json.dumps(states, sort_keys=True), "application/json"
+        state = snapshot.get(key)
+        if state is None and self._devices.lookup(key) is not None:
+            key = self._devices.lookup(key)
+            state = snapshot.get(key)
+        if state is None:
+            return 404, "Unknown device [%s]" % key
+        return 200, json.dumps(self._aged(state, now), sort_keys=True), "application/json"
+
+    def _aged(self, state, now):
+        state = dict(state)
+        state['age'] = round(now - state['timestamp'], 1) if state['timestamp'] is not None else None
+        return state
+
+    def _track_all(self):
+        """
+        Rebuild the snapshot from the current devices of all modules: drops devices
+        removed by a reload or expired, and refreshes last seen and round trip times
+        """
+        devices = []
+        if self._ping['discover']:
+            devices.extend(('ping', device) for device in self._ping['discover'].pings)
+        if self._bluetooth['discover']:
+            devices.extend(('bluetooth', device) for device in self._bluetooth['discover'].devices)
+        if self._http['discover']:
+            devices.extend(('http', device) for device in self._http['discover'].devices if device.zone is not None)
+        entries = {}
+        for kind, device in devices:
+            entries.setdefault(device.key, {})[kind] = self._module_state(kind, device)
+        self._snapshot = dict((key, self._device_state(key, modules)) for key, modules in entries.items())
+
+    def _snapshot_event(self):
+        interval = self._http['snapshot']
+        try:
+            self._track_all()
+            if self._ping['discover'] and any(device.online is None and device.ip is not None
+                                              for device in self._ping['discover'].pings):
+                # first probes matching the configured online state are no transition:
+                # refresh every second until every device has a result
+                interval = min(interval, 1)
+        finally:
+            self._loop.call_later(interval, self._snapshot_event)
 
     def pir_motion(self, pin):
         self._logger.info("Pir motion detected!")
+        self._stream('pir.motion', data={'pin': pin})
+        self._publish('pir.motion', data={'pin': pin})
 
     def pir_idle(self):
         self._logger.info("Pir idle since %d seconds" % self._pir['timeout'])
+        self._stream('pir.idle', data={'timeout': self._pir['timeout']})
+        self._publish('pir.idle', data={'timeout': self._pir['timeout']})
+
+    def _publish(self, name, payload=None, data=None):
+        if self._events['discover']:
+            self._events['discover'].publish(name, payload, data)
+
+    def _publisher(self, name):
+        """
+        :return: device callback queueing the event on the event bus
+        """
+        def publish(payload):
+            self._events['discover'].publish(name, payload)
+        return publish
 
-    def __init__(self, logger, options, devices):
+    def __init__(self, logger, options, devices, loader=None):
 
         self._logger = logger
         assert isinstance(logger, logging.Logger)
 
         self._options = options
-        self._devices = devices
+        self._devices = DeviceRegistry.wrap(devices)
+        self._loader = loader
 
         self._logger.debug("Controller constructor ...")
 
+        self._loop = None
+        self._snapshot = {}     # key -> device state served by /devices, rebuilt by the event loop
+
+        self._events = options['events']
+        self._events['discover'] = None
+        self._events['logger'] = self._logger
+
         self._root = options['controller']['root']
         self._pidfile = options['controller']['pidfile']
 
         self._ping = options['ping']
         self._ping['discover'] = None
         self._ping['logger'] = self._logger
-        self._ping['callback'] = {'new': self.ping_new, 'off': self.ping_off}
+        self._ping['callback'] = {'new': self.ping_new, 'off': self.ping_off, 'batch': self.ping_batch}
+
+        self._arp = options['arp']
+        self._arp['discover'] = None
+        self._arp['logger'] = self._logger
 
         self._bluetooth = options['bluetooth']
         self._bluetooth['discover'] = None
+        self._bluetooth['prober'] = None
         self._bluetooth['logger'] = self._logger
         self._bluetooth['callback'] = {'new': self.bluetooth_new, 'off': self.bluetooth_off}
 
@@ -298,6 +505,16 @@ class Controller():
                 self._logger.error("Pir module detection not avalaible on %s architecture!" % platform.machine())
                 self._pir['enabled'] = False
 
+        if self._events['enabled']:
+            # ping and bluetooth events are handled on the callback sink thread instead of the probes
+            handlers = {}
+            for name, section in [('ping', self._ping), ('bluetooth', self._bluetooth)]:
+                for event in section['callback'].keys():
+                    handlers['%s.%s' % (name, event)] = section['callback'][event]
+                    section['callback'][event] = self._publisher('%s.%s' % (name, event))
+            self._events['discover'] = EventBus(self._logger, self._events,
+                                                [CallbackSink(self._logger, self._events, handlers)])
+
         if self._bluetooth['enabled']:
             self._bluetooth['discover'] = BluetoothDiscoverDevice(self._logger, self._bluetooth, self._devices)
 
@@ -306,6 +523,8 @@ class Controller():
 
         if self._ping['enabled']:
             self._ping['discover'] = PingDiscoverDevice(self._logger, self._ping, self._devices)
+            if self._arp['enabled']:
+                self._arp['discover'] = ArpDiscoverDevice(self._logger, self._arp, self._ping['discover'])
 
         if self._http['enabled']:
             self._http['discover'] = HttpDiscoverDevice(self._logger, self._http, self._devices)
@@ -313,10 +532,57 @@ class Controller():
         if self._pipe['enabled']:
             self._pipe['discover'] = PipeRequest(self._logger, self._pipe)
 
+        self._checkpoint = StateCheckpoint(self._logger, self._options['controller']['state'])
+        self._checkpoint.restore(self._stateful())
+
+    def _stateful(self):
+        return {'ping': self._ping['discover'],
+                'http': self._http['discover'],
+                'bluetooth': self._bluetooth['discover']}
+
+    def _checkpoint_event(self):
+        try:
+            self._checkpoint.save(self._stateful())
+        finally:
+            self._loop.call_later(self._options['controller']['checkpoint'], self._checkpoint_event)
+
+    def _pipe_event(self):
+        # the fifo is re-opened after the last writer closed it
+        self._loop.remove_reader(self._pipe['discover'].fifo)
+        self._pipe['discover'].process_event()
+        self._loop.add_reader(self._pipe['discover'].fifo, self._pipe_event)
+
+    def _http_event(self):
+        # the listener is readable: accept without handle_request(), which selects again (FD_SETSIZE)
+        self._http['discover'].httpd._handle_request_noblock()
+
+    def _bluetooth_event(self):
+        self._bluetooth['discover'].process_event()
+        if self._bluetooth['discover'].done:
+            self._bluetooth['discover'].expired(self._bluetooth['expire'])
+            # drop the expired devices from the snapshot
+            self._track_all()
+            if self._bluetooth['inquiry'] > 0:
+                # known devices are checked by probes, full inquiries only find new devices
+                self._loop.call_later(self._bluetooth['inquiry'], self._bluetooth['discover'].find_devices)
+            else:
+                self._bluetooth['discover'].find_devices()
+
     def run(self):
 
+        self._loop = EventLoop(self._logger, self._options['controller']['poller'])
+
+        if self._events['discover']:
+            self._events['discover'].start()
+
         if self._ping['discover']:
-            self._ping['discover'].listen()
+            self._ping['discover'].listen(self._loop)
+
+        if self._arp['discover']:
+            self._arp['discover'].attach(self._loop)
+
+        if self._http['discover']:
+            self._snapshot_event()
 
         if self._pir['discover']:
             import RPi.GPIO as GPIO
@@ -324,61 +590,106 @@ class Controller():
             GPIO.setmode(GPIO.BOARD)
             GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
             GPIO.add_event_detect(pin, GPIO.RISING)
-            GPIO.add_event_callback(pin, self._pir['discover'].motion)
-            self._pir['discover'].start()
+            # gpio callbacks are called from the RPi.GPIO thread
+            GPIO.add_event_callback(pin, lambda channel: self._loop.call_soon_threadsafe(
+                self._pir['discover'].motion, channel))
+            self._pir['discover'].attach(self._loop)
 
-        rf = []
         if self._pipe['discover']:
             self._pipe['discover'].listen()
-            rf.append(self._pipe['discover'].fifo)
+            self._loop.add_reader(self._pipe['discover'].fifo, self._pipe_event)
 
         if self._http['discover']:
             self._http['discover'].listen()
-            rf.append(self._http['discover'].socket)
+            self._loop.add_reader(self._http['discover'].socket, self._http_event)
 
         if self._bluetooth['discover']:
-            rf.append(self._bluetooth['discover'])
+            self._loop.add_reader(self._bluetooth['discover'], self._bluetooth_event)
+            self._bluetooth['discover'].attach(self._loop)
             self._bluetooth['discover'].find_devices()
 
-        # rf = [self._bluetooth['discover'], self._pipe['discover'].fifo, self._http['discover'].socket, ]
+            if self._bluetooth['probe'] > 0:
+                discover = self._bluetooth['discover']
+                self._bluetooth['prober'] = BluetoothProbe(self._logger, self._bluetooth, discover,
+                    lambda results: self._loop.call_soon_threadsafe(discover.process_probe, results))
+                self._bluetooth['prober'].start()
+
+        if self._checkpoint.path and self._options['controller']['checkpoint'] > 0:
+            self._loop.call_later(self._options['controller']['checkpoint'], self._checkpoint_event)
+
+        self._loop.run()
+
+    # signal handler called with signal number and stack frame
+    def reload(self, *args):
+        if self._loop is not None:
+            # apply the configuration between two event loop callbacks
+            self._loop.call_soon_signalsafe(self._reload)
+
+    def _reload(self):
 
-        while True:
+        self._logger.info("Controller reload ...")
 
-            rfds = select.select(rf, [], [])[0]
+        if self._loader is None:
+            self._logger.error("No configuration loader. Reload ignored!")
+            return
 
-            if self._pipe['discover']:
-                if self._pipe['discover'].fifo in rfds:
-                    self._pipe['discover'].process_event()
+        try:
+            (options, devices) = self._loader()
+        except Exception, e:
+            self._logger.error("Error reading configuration: %s. Reload ignored!" % e)
+            return
 
-            if self._http['discover']:
-                if self._http['discover'].socket in rfds:
-                    self._http['discover'].httpd.handle_request()
+        changed = self._devices.reload(devices)
+        self._logger.info("Reload: %d device configuration(s) changed" % len(changed))
 
-            if self._bluetooth['discover']:
+        for section in ['bluetooth', 'ping', 'arp', 'http', 'pipe', 'pir', 'events']:
+            if options[section]['enabled'] != self._options[section]['enabled']:
+                self._logger.warn("Reload: Enabling/disabling [%s] requires a restart!" % section)
 
-                if self._bluetooth['discover'] in rfds:
-                    self._bluetooth['discover'].process_event()
+        if self._ping['discover']:
+            self._ping['discover'].reload(options['ping'], changed)
 
-                if self._bluetooth['discover'].done:
-                    # time.sleep(1)
-                    self._bluetooth['discover'].expired(self._bluetooth['expire'])
-                    self._bluetooth['discover'].find_devices()
+        if self._arp['discover']:
+            self._arp['discover'].reload(options['arp'])
 
-    # signal handler called with signal number and stack frame
-    def reload(self, *args):
-        self._logger.info("Controller reload ...")
-        self._logger.debug(args)
+        if self._http['discover']:
+            fd = self._http['discover'].socket.fileno()
+            if self._http['discover'].reload(options['http'], changed):
+                self._loop.remove_reader(fd)
+                self._http['discover'].listen()
+                self._loop.add_reader(self._http['discover'].socket, self._http_event)
+
+        if self._bluetooth['discover']:
+            self._bluetooth['discover'].reload(options['bluetooth'], changed)
+
+        # restarted probes and recreated devices replace the previous ones
+        self._track_all()
+
+        # keep runtime entries (discover, logger, callback) of the sections
+        for section in ['bluetooth', 'ping', 'arp', 'http']:
+            for key in options[section]:
+                if key != 'enabled':
+                    self._options[section][key] = options[section][key]
 
     def exit(self, *args):
 
         self._logger.info("Controller exit ...")
 
+        if self._checkpoint:
+            self._checkpoint.save(self._stateful())
+
         if self._pipe['discover']:
             self._pipe['discover'].close()
 
         if self._http['discover']:
             self._http['discover'].close()
 
+        if self._bluetooth['prober']:
+            self._bluetooth['prober'].shutdown()
+
+        if self._bluetooth['discover']:
+            self._bluetooth['discover'].shutdown()
+
         if self._pir['discover']:
             import RPi.GPIO as GPIO
             pin = self._pir['gpio']
@@ -386,10 +697,16 @@ class Controller():
             GPIO.cleanup(pin)
             self._pir['discover'].shutdown()
 
+        if self._arp['discover']:
+            self._arp['discover'].shutdown()
+
         if self._ping['discover']:
             self._logger.info("Notify ping threads. Please wait ...")
             self._ping['discover'].shutdown()
 
+        if self._events['discover']:
+            self._events['discover'].shutdown()
+
         exit(0)
 
     def request(self, *args):
@@ -453,6 +770,38 @@ def daemonize(controller):
         controller.run()
 
 
+def read_config(defaults):
+    """
+    Read options from the configuration files and the environment and
+    the device configuration
+    :return: tuple (options, devices)
+    """
+    options = {}
+    devices = {}
+
+    config = DefaultConfigParser(defaults)
+    config.read(defaults['controller']['config'])
+
+    # get options from environment and/or configuration files
+    for sec in defaults:
+        options[sec] = {}
+        for key in defaults[sec]:
+            env_key = 'DEVICE_DAEMON_' + sec.upper() + '_' + key.upper()
+            env_val = os.getenv(env_key)
+            options[sec][key] = env_val if env_val else config.get(sec, key)
+
+    # get device configuration options
+    dev_cfg = SafeConfigParser()
+    dev_cfg.read(options['controller']['dev'])
+    for sec in dev_cfg.sections():
+        device = {'key': sec}
+        for opt in dev_cfg.options(sec):
+            device[opt] = dev_cfg.get(sec, opt)
+        devices[sec] = device
+
+    return options, devices
+
+
 def main():
     def callback(self, device):
         assert (isinstance(device, Device))
@@ -462,8 +811,6 @@ def main():
     root = home + '/DeviceDaemon'
 
     defaults = {}
-    options = {}
-    devices = {}
 
     # command line arguments
     parser = argparse.ArgumentParser(description='Python Device Daemon Rev. 0.1 (c) Bernd Strebel')
@@ -498,24 +845,65 @@ def main():
                   'log': root + '/logging.cfg',
                   'dev': root + '/devices.cfg',
                   'loglevel': 'DEBUG',
+                  'poller': 'auto',
+                  'state': 'state.json',
+                  'checkpoint': 60,
                   'pidfile': '/var/run/DeviceDaemon.pid',
                   'daemon': False}
 
     bluetooth = {'enabled': True,
                  'expire': 300,
+                 'probe': 0,
+                 'probe_timeout': 5,
+                 'inquiry': 0,
+                 'cache': 'bluetooth.cache',
+                 'cache_refresh': 86400,
+                 'cache_negative': 3600,
+                 'cache_size': 10000,
+                 'threshold': 1,
+                 'window': 1,
                  'devices': []}
 
     ping = {'enabled': True,
             'sleep': 10,
+            'min_sleep': 0,
+            'max_sleep': 0,
+            'jitter': 0,
             'timeout': 1,
             'psize': 64,
             'online': True,
+            'multiplex': False,
+            'batch': 0,
+            'dns_ttl': 300,
+            'dns_negative_ttl': 60,
+            'dns_workers': 8,
+            'stats_window': 100,
+            'threshold': 1,
+            'window': 1,
+            'confirm': 0,
+            'confirm_interval': 200,
+            'sweep': '',
+            'sweep_rate': 1000,
+            'sweep_interval': 300,
             'devices': []}
 
+    # passive presence of the ping devices from the arp table
+    arp = {'enabled': False,
+           'path': '/proc/net/arp',
+           'interval': 10,
+           # departures are detected up to expire + ping sleep seconds late
+           'expire': 30}
+
     http = {'enabled': True,
             'host': '0.0.0.0',
             'port': 8080,
             'key': 'serial',
+            'pool': 0,
+            'backlog': 5,
+            'keepalive': 0,
+            'stream': 256,
+            # seconds between refreshes of last seen and round trip times served by /devices
+            'snapshot': 10,
             'devices': []}
 
     pipe = {'enabled': True,
@@ -525,39 +913,38 @@ def main():
            'gpio': 7,
            'timeout': 60}
 
+    # asynchronous event delivery, policy for full queues: block, drop_new or drop_old
+    events = {'enabled': True,
+              'queue': 1000,
+              'policy': 'block',
+              'sinks': '',
+              'file': 'events.log',
+              'fifo': '/tmp/DeviceDaemon.events',
+              'webhook': 'http://localhost/events',
+              'webhook_timeout': 5,
+              'webhook_window': 500,
+              'webhook_batch': 100,
+              'webhook_retry': 3,
+              'webhook_backoff': 1}
+
     defaults = {'controller': controller,
                 'bluetooth': bluetooth,
                 'ping': ping,
+                'arp': arp,
                 'http': http,
                 'pipe': pipe,
-                'pir': pir}
+                'pir': pir,
+                'events': events}
 
     # read configuration files
-    config = DefaultConfigParser(defaults)
     if args.ignore:
         defaults['controller']['config'] = []
 
     if args.config:
         defaults['controller']['config'].append(args.config)
 
-    config.read(defaults['controller']['config'])
-
-    # get options from environment and/or configuration files
-    for sec in defaults:
-        options[sec] = {}
-        for key in defaults[sec]:
-            env_key = 'DEVICE_DAEMON_' + sec.upper() + '_' + key.upper()
-            env_val = os.getenv(env_key)
-            options[sec][key] = env_val if env_val else config.get(sec, key)
-
-    # get device configuration options
-    dev_cfg = SafeConfigParser()
-    dev_cfg.read(options['controller']['dev'])
-    for sec in dev_cfg.sections():
-        devices[sec] = {}
-        devices[sec]['key'] = sec
-        for opt in dev_cfg.options(sec):
-            devices[sec][opt] = dev_cfg.get(sec, opt)
+    (options, devices) = read_config(defaults)
+    devices = DeviceRegistry(devices)
 
     if args.log:
         options['controller']['log'] = args.log
@@ -597,12 +984,13 @@ def main():
     logger.debug(pp.pformat(options))
     logger.debug(pp.pformat(devices))
 
-    controller = Controller(logger, options, devices)
+    controller = Controller(logger, options, devices, lambda: read_config(defaults))
     controller.init()
 
     if options['controller']['daemon']:
         daemonize(controller)
     else:
+        signal.signal(signal.SIGUSR1, controller.reload)
         try:
             controller.run()
         except KeyboardInterrupt:
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+    passive presence of ip devices from the kernel neighbour table
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import threading
+import logging
+import time
+
+from Device import *
+
+
+class ArpDiscoverDevice(threading.Thread):
+    """
+    Read the arp table periodically and hand the complete entries over to
+    the ping devices. Devices with a new or changed entry are online without
+    a probe, devices with a persisting entry are only probed every expire
+    seconds and devices without an entry are probed as usual.
+
+    /proc/net/arp has no neighbour state (REACHABLE/STALE) but only the
+    complete flag, so entries persisting unchanged are not trusted longer
+    than expire seconds after the last successful probe. A departed device
+    keeps its entry for a while, so it is detected as offline up to expire
+    seconds later than by probing alone: expire trades probes for latency
+    and should stay a small multiple of the ping sleep, e.g. the kernel's
+    reachable time of 30 seconds.
+    """
+
+    _complete = 0x2     # ATF_COM
+
+    def __init__(self, logger, options, ping):
+
+        threading.Thread.__init__(self)
+        assert isinstance(logger, logging.Logger)
+        self._logger = logger
+        self._ping = ping
+        self._path = options['path']
+        self._interval = options['interval']
+        self._expire = options['expire']
+        self._entries = {}      # ip -> hw address of complete entries
+        self._seeded = False
+        self._loop = None
+        self._shutdown = False
+
+    def read(self):
+        """
+        :return: dictionary of hw addresses by ip address for complete entries
+        """
+        entries = {}
+        try:
+            with open(self._path) as table:
+                table.readline()
+                for line in table:
+                    fields = line.split()
+                    if len(fields) < 4:
+                        continue
+                    try:
+                        flags = int(fields[2], 16)
+                    except ValueError:
+                        continue
+                    if flags & self._complete and fields[3] != '00:00:00:00:00:00':
+                        entries[fields[0]] = fields[3].lower()
+        except IOError, e:
+            self._logger.error("Arp: Error reading %s: %s" % (self._path, e))
+        return entries
+
+    def check(self):
+        """
+        Update the passive presence of all ping devices
+        :return: number of ping devices with a complete entry
+        """
+        entries = self.read()
+        present = 0
+        for ping in self._ping.pings:
+            address = entries.get(ping.ip)
+            if address is not None:
+                present += 1
+            # entries of the first read may be stale (e.g. after a restart): nothing is fresh
+            fresh = self._seeded and address is not None and self._entries.get(ping.ip) != address
+            ping.seen(address is not None, fresh, self._expire)
+        self._entries = entries
+        self._seeded = True
+        self._logger.debug("Arp: %d entries, %d ping devices present" % (len(entries), present))
+        return present
+
+    def run(self):
+        self._logger.info("Arp discovery started with interval of %d seconds ..." % self._interval)
+        while not self._shutdown:
+            self.check()
+            time.sleep(self._interval)
+        self._logger.info("Arp discovery stopped!")
+
+    def attach(self, loop):
+        """
+        Read the arp table from the event loop instead of an own thread
+        """
+        self._logger.info("Arp discovery attached to event loop with interval of %d seconds ..." % self._interval)
+        self._loop = loop
+        self._loop.call_later(0, self._loop_tick)
+
+    def _loop_tick(self):
+        if self._shutdown:
+            self._logger.info("Arp discovery stopped!")
+            return
+        self.check()
+        self._loop.call_later(self._interval, self._loop_tick)
+
+    def reload(self, options):
+        self._path = options['path']
+        self._interval = options['interval']
+        self._expire = options['expire']
+
+    def shutdown(self):
+        self._shutdown = True
+
+    @property
+    def entries(self): return self._entries
+
+
+# region __main__
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-7s %(message)s', level=logging.DEBUG)
+
+    class Ping:
+        def __init__(self, ip): self.ip = ip
+        def seen(self, present, fresh, expire): print("[%s] present: %s fresh: %s" % (self.ip, present, fresh))
+
+    class Pings:
+        pings = [Ping('192.168.1.1'), Ping('192.168.1.2')]
+
+    discover = ArpDiscoverDevice(logging.getLogger(), {'path': '/proc/net/arp', 'interval': 10, 'expire': 30},
+                                 Pings())
+    discover.check()
+# endregion
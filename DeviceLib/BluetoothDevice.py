@@ -11,8 +11,19 @@ import bluetooth
 import select
 import re
 import copy
+import heapq
+import threading
+import json
+import os
+import collections
+import Queue
 
 from Device import *
+from Registry import DeviceRegistry
+from Metrics import metrics, DURATION_BUCKETS
+
+_inquiry = metrics.histogram('devicedaemon_bluetooth_inquiry_seconds', 'Bluetooth inquiry duration',
+                             buckets=DURATION_BUCKETS)
 
 
 class BluetoothDevice(Device):
@@ -20,11 +31,9 @@ class BluetoothDevice(Device):
     _pattern = re.compile("[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}")
 
     @staticmethod
-    def _get_bt_name(address):
-        for a, n in bluetooth.discover_devices(lookup_names=True):
-            if a == address:
-                return n
-        return None
+    def _get_bt_name(address, timeout=10):
+        # targeted remote name request instead of a full inquiry
+        return bluetooth.lookup_name(address, timeout)
 
     @staticmethod
     def _get_bt_address(name):
@@ -33,12 +42,14 @@ class BluetoothDevice(Device):
                 return a
         return None
 
-    def __init__(self, logger, config, name):
+    __slots__ = ('_address', '_name')
+
+    def __init__(self, logger, config, name, address=None):
 
         self._logger = logger
-        self._address = config['bt']
+        self._address = config['bt'] if address is None else address
         self._name = name
-        Device.__init__(self, logger, config)
+        Device.__init__(self, logger, config, self._address if address is not None else None)
 
     def check(self, callback):
         if self._get_bt_name(self._address) is None:
@@ -46,8 +57,13 @@ class BluetoothDevice(Device):
         self.update()
         return True
 
+    def state(self):
+        state = Device.state(self)
+        state['name'] = self._name
+        return state
+
     @property
-    def known(self): return self.config('key') != self.config('bt')
+    def known(self): return self._key != self._address
 
     @property
     def address(self): return self._address
@@ -56,6 +72,138 @@ class BluetoothDevice(Device):
     def name(self): return self._name
 
 
+class BluetoothNameCache:
+    """
+    Persistent address -> name cache: names younger than refresh seconds
+    are reused instead of sending remote name requests. Failed requests
+    are cached for negative seconds. Outdated entries are dropped when the
+    cache is saved, the newest size entries are kept.
+    """
+
+    def __init__(self, logger, path, refresh, negative=3600, size=10000):
+
+        self._logger = logger
+        self._path = path
+        self._refresh = refresh
+        self._negative = negative
+        self._size = size
+        self._names = {}    # address -> [name, timestamp], name None for failed requests
+        self._dirty = False
+
+    def _fresh(self, entry):
+        return time.time() - entry[1] < (self._refresh if entry[0] is not None else self._negative)
+
+    def get(self, address):
+        """
+        :return: tuple (cached, name), name is None for devices that did not answer
+        """
+        entry = self._names.get(address)
+        if entry is not None and self._fresh(entry):
+            return True, entry[0]
+        return False, None
+
+    def put(self, address, name):
+        entry = self._names.get(address)
+        if entry is None or entry[0] != name or not self._fresh(entry):
+            self._names[address] = [name, time.time()]
+            self._dirty = True
+
+    def prune(self):
+        """
+        Drop outdated entries and the oldest ones beyond the cache size
+        :return: number of dropped entries
+        """
+        count = len(self._names)
+        names = [(address, entry) for address, entry in self._names.items() if self._fresh(entry)]
+        if self._size and len(names) > self._size:
+            names = heapq.nlargest(self._size, names, key=lambda item: item[1][1])
+        if len(names) < count:
+            self._names = dict(names)
+        return count - len(self._names)
+
+    def load(self):
+        if not self._path or not os.path.isfile(self._path):
+            return
+        try:
+            with open(self._path) as cache:
+                self._names = json.load(cache)
+            self._logger.info("Bluetooth: Loaded %d names from %s" % (len(self._names), self._path))
+        except (IOError, ValueError), e:
+            self._logger.error("Bluetooth: Error loading name cache %s: %s" % (self._path, e))
+
+    def save(self):
+        if self.prune():
+            self._dirty = True
+        if not self._path or not self._dirty:
+            return
+        try:
+            with open(self._path + '.tmp', 'w') as cache:
+                json.dump(self._names, cache, separators=(',', ':'))
+            os.rename(self._path + '.tmp', self._path)
+            self._dirty = False
+        except (IOError, OSError), e:
+            self._logger.error("Bluetooth: Error saving name cache %s: %s" % (self._path, e))
+
+    @property
+    def names(self): return self._names
+
+
+class BluetoothNameLookup(threading.Thread):
+    """
+    Remote name requests for addresses missing in the name cache, one at a
+    time on a worker thread instead of the thread running the inquiries.
+    Results are handed over with the deliver function.
+    """
+
+    def __init__(self, logger, timeout, deliver):
+
+        threading.Thread.__init__(self)
+        self._logger = logger
+        self._timeout = timeout
+        self._deliver = deliver
+        self._queue = Queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._started = False
+        self._shutdown = False
+
+    def put(self, address):
+        with self._lock:
+            if address in self._pending:
+                return
+            self._pending.add(address)
+            if not self._started:
+                self._started = True
+                self.start()
+        self._queue.put(address)
+
+    def run(self):
+        self._logger.info("Bluetooth name lookup started ...")
+        while not self._shutdown:
+            try:
+                address = self._queue.get(True, 1)
+            except Queue.Empty:
+                continue
+            try:
+                name = BluetoothDevice._get_bt_name(address, self._timeout)
+            except bluetooth.BluetoothError, e:
+                self._logger.debug("Bluetooth name request [%s] failed: %s" % (address, e))
+                name = None
+            with self._lock:
+                self._pending.discard(address)
+            self._deliver(address, name)
+        self._logger.info("Bluetooth name lookup stopped!")
+
+    def shutdown(self):
+        self._shutdown = True
+
+    @property
+    def deliver(self): return self._deliver
+
+    @deliver.setter
+    def deliver(self, deliver): self._deliver = deliver
+
+
 class BluetoothDiscoverDevice(bluetooth.DeviceDiscoverer):
 
     def __init__(self, logger, options, devices):
@@ -66,41 +214,91 @@ class BluetoothDiscoverDevice(bluetooth.DeviceDiscoverer):
         self._callback = options['callback']
         
         self._done = False
-        self._inquired = []
+        self._inquired = set()
+        self._online = set()
+        self._started = time.time()
+        self._expiry = []   # heap of (timestamp, address), one entry per sighting
         self._devices = {}
-
-        self._known = {}
-        for device in options['devices']:
-            if device in devices and 'bt' in devices[device]:
-                self._known[devices[device]['bt']] = devices[device]
+        # configuration shared by all unknown devices
+        self._unknown = {'callback': self._callback}
+
+        self._registry = DeviceRegistry.wrap(devices)
+        self._known = set([device for device in options['devices']
+                           if device in self._registry and 'bt' in self._registry[device]])
+
+        # addresses of known devices checked by targeted probes instead of inquiries
+        self._probed = set()
+        self._probe_timeout = int(options.get('probe_timeout', 5))
+
+        # n of m hysteresis: devices go offline if missed threshold times within window checks
+        self._history = {}
+        self._threshold = int(options.get('threshold', 1))
+        self._window = max(int(options.get('window', 1)), self._threshold)
+
+        self._names = None
+        self._lookup = None
+        if options.get('cache'):
+            self._names = BluetoothNameCache(self._logger, options['cache'], int(options.get('cache_refresh', 86400)),
+                                             int(options.get('cache_negative', 3600)),
+                                             int(options.get('cache_size', 10000)))
+            self._names.load()
+            self._lookup = BluetoothNameLookup(self._logger, self._probe_timeout, self.process_name)
+
+    def find_devices(self, lookup_names=True, duration=8, flush_cache=True):
+        if self._names is not None:
+            # names are looked up per address in device_discovered
+            lookup_names = False
+        bluetooth.DeviceDiscoverer.find_devices(self, lookup_names, duration, flush_cache)
 
     def pre_inquiry(self):
         self._logger.debug("Starting bluetooth inquiry ...")
         self._done = False
-        self._inquired = []
+        self._inquired = set()
+        self._started = time.time()
 
     def device_discovered(self, address, device_class, name):
 
-        self._inquired.append(address)
+        self._inquired.add(address)
+
+        if self._names is not None and name is None:
+            (cached, name) = self._names.get(address)
+            if not cached:
+                # unknown or outdated: remote name request on the lookup thread
+                self._lookup.put(address)
+                if address not in self._devices:
+                    # reported by process_name once the name is known
+                    return
+                name = self._devices[address].name
+
+        self._present(address, name)
+
+    def process_name(self, address, name):
+        """
+        Result of a remote name request of the lookup thread
+        """
+        self._names.put(address, name)
+        if address not in self._devices and address in self._online | self._inquired:
+            self._present(address, name)
+
+    def _present(self, address, name):
 
         if address in self._devices:
             self._logger.debug("Bluetooth device update [%s] %s " % (address, name))
             self._devices[address].update()
             self._devices[address].online = True
+            heapq.heappush(self._expiry, (self._devices[address].timestamp, address))
         else:
             self._logger.debug("Discovered [%s] %s" % (address, name))
-            device = {}
-
-            if address in self._known:
-                device = copy.deepcopy(self._known[address])
+            key = self._registry.find('bt', address)
+            if key in self._known:
+                device = BluetoothDevice(self._logger, self._registry.config(key, {'callback': self._callback}), name)
             else:
-                device = {'key': address, 'bt': address, 'display': name}
-
-            device['callback'] = self._callback
+                device = BluetoothDevice(self._logger, self._unknown, name, address)
 
-            self._devices[address] = BluetoothDevice(self._logger, device, name)
+            self._devices[address] = device
             self._devices[address].update()
             self._devices[address].online = True
+            heapq.heappush(self._expiry, (device.timestamp, address))
             self._devices[address].callback('new')
             # Device.callback(self._devices[address],'new')
 
@@ -108,31 +306,195 @@ class BluetoothDiscoverDevice(bluetooth.DeviceDiscoverer):
 
         self._logger.debug("Bluetooth inquiry completed")
 
-        for addr in self._devices:
-            if addr not in self._inquired:
-                device = self._devices[addr]
+        for addr in self._inquired:
+            self._missed(addr, False)
+
+        # only devices online in the previous inquiry can go offline
+        pending = set()
+        for addr in self._online - self._inquired - self._probed:
+            device = self._devices.get(addr)
+            if device is not None and device.online:
+                if not self._missed(addr, True):
+                    pending.add(addr)
+                    continue
                 self._logger.debug("Offline [%s] %s" % ( device.address, device.name))
-                if device.online:
-                    device.online = False
-                    device.callback('off')
-                    # Device.callback(device, 'off')
+                device.online = False
+                device.callback('off')
+                # Device.callback(device, 'off')
 
+        self._online = (self._online & self._probed) | self._inquired | pending
         self._done = True
+        _inquiry.observe(time.time() - self._started)
+
+        if self._names is not None:
+            self._names.save()
+
+    def _missed(self, address, missed):
+        """
+        Record the result of an inquiry or probe for a device
+        :return: True, if the device was missed threshold times within the window
+        """
+        if self._threshold == 1:
+            return missed
+        # histories only exist while the window contains a miss: no history means all hits
+        history = self._history.get(address)
+        if history is None:
+            if not missed:
+                return False
+            history = self._history[address] = collections.deque(maxlen=self._window)
+        history.append(missed)
+        if missed and history.count(True) >= self._threshold:
+            del self._history[address]
+            return True
+        if not missed and True not in history:
+            del self._history[address]
+            return False
+        if missed:
+            self._logger.debug("Bluetooth device [%s] missed (%d of %d)" % (address, history.count(True),
+                                                                            self._threshold))
+        return False
+
+    def state(self):
+        return dict((address, device.state()) for address, device in self._devices.items())
+
+    def restore(self, state):
+        """
+        Recreate the devices of a checkpoint: the first inquiry
+        then only reports devices that changed meanwhile
+        """
+        for address, saved in state.items():
+            key = self._registry.find('bt', address)
+            if key in self._known:
+                device = BluetoothDevice(self._logger, self._registry.config(key, {'callback': self._callback}),
+                                         saved.get('name'))
+            else:
+                device = BluetoothDevice(self._logger, self._unknown, saved.get('name'), address)
+            device.restore(saved)
+            self._devices[address] = device
+            heapq.heappush(self._expiry, (device.timestamp, address))
+            if device.online:
+                self._online.add(address)
+        self._logger.debug("Bluetooth: Restored %d devices" % len(state))
+
+    def reload(self, options, changed):
+        """
+        Update the known devices: devices whose known state or configuration
+        changed are recreated with their current state
+        :param options: new options of the bluetooth section
+        :param changed: keys of added, removed or changed device configurations
+        """
+        self._known = set([device for device in options['devices']
+                           if device in self._registry and 'bt' in self._registry[device]])
+        self._probed = set()
+        self._probe_timeout = int(options.get('probe_timeout', 5))
+
+        self._history = {}
+        self._threshold = int(options.get('threshold', 1))
+        self._window = max(int(options.get('window', 1)), self._threshold)
+
+        for address, device in self._devices.items():
+            key = self._registry.find('bt', address)
+            if device.known != (key in self._known) or device.key in changed or key in changed:
+                self.restore({address: device.state()})
+
+    def probe_known(self):
+        """
+        Check presence of the known devices with remote name requests.
+        Blocks for up to probe_timeout seconds per absent device.
+        :return: list of (address, name) tuples, name is None for absent devices
+        """
+        results = []
+        for key in list(self._known):
+            address = self._registry[key]['bt']
+            try:
+                name = BluetoothDevice._get_bt_name(address, self._probe_timeout)
+            except bluetooth.BluetoothError, e:
+                self._logger.debug("Bluetooth probe [%s] failed: %s" % (address, e))
+                continue
+            results.append((address, name))
+        return results
+
+    def process_probe(self, results):
+
+        for address, name in results:
+            self._probed.add(address)
+            if self._names is not None:
+                self._names.put(address, name)
+            if name is not None:
+                self._missed(address, False)
+                self._present(address, name)
+                self._online.add(address)
+            else:
+                device = self._devices.get(address)
+                if device is not None and device.online:
+                    if not self._missed(address, True):
+                        continue
+                    self._logger.debug("Offline [%s] %s" % (device.address, device.name))
+                    device.online = False
+                    device.callback('off')
+                self._online.discard(address)
 
     def expired(self, seconds):
 
-        # try: self.devices
-        # except AttributeError: self.devices = {}
-
-        for addr, device in self._devices.items():
-            if device.age > seconds:
+        # pop sightings older than seconds: entries of devices seen again later are outdated
+        limit = time.time() - seconds
+        while self._expiry and self._expiry[0][0] < limit:
+            (timestamp, addr) = heapq.heappop(self._expiry)
+            device = self._devices.get(addr)
+            if device is not None and device.timestamp == timestamp:
                 self._logger.info("Expired [%s] %s" % (device.address, device.name))
-                del device
                 del self._devices[addr]
+                self._history.pop(addr, None)
+                self._online.discard(addr)
+
+    def attach(self, loop):
+        """
+        Deliver the results of the name lookup thread to the event loop thread
+        """
+        if self._lookup is not None:
+            self._lookup.deliver = lambda address, name: loop.call_soon_threadsafe(self.process_name, address, name)
+
+    def shutdown(self):
+        if self._lookup is not None:
+            self._lookup.shutdown()
 
     @property
     def done(self): return self._done
 
+    @property
+    def devices(self): return self._devices.values()
+
+
+class BluetoothProbe(threading.Thread):
+    """
+    Periodically probe the known bluetooth devices of a discoverer. Results
+    are handed over with the deliver function, e.g. to the event loop thread.
+    """
+
+    def __init__(self, logger, options, discover, deliver=None):
+
+        threading.Thread.__init__(self)
+        self._logger = logger
+        self._discover = discover
+        self._deliver = discover.process_probe if deliver is None else deliver
+        self._sleep = int(options['probe'])
+        self._shutdown = False
+
+    def run(self):
+        self._logger.info("Bluetooth probe started with interval of %d seconds ..." % self._sleep)
+        while not self._shutdown:
+            started = time.time()
+            self._deliver(self._discover.probe_known())
+            self._logger.debug("Bluetooth probe completed in %.1f seconds" % (time.time() - started))
+            for second in range(self._sleep):
+                if self._shutdown:
+                    break
+                time.sleep(1)
+        self._logger.info("Bluetooth probe stopped!")
+
+    def shutdown(self):
+        self._shutdown = True
+
 
 # region Main
 if __name__ == '__main__':
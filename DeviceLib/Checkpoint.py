@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+    persistent snapshot of the device state for warm restarts
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import os
+import json
+import logging
+import time
+
+
+class StateCheckpoint:
+    """
+    Write the state of all discover modules to a compact JSON file and
+    read it back at startup. Modules provide state() and restore(state).
+    """
+
+    def __init__(self, logger, path):
+
+        assert isinstance(logger, logging.Logger)
+        self._logger = logger
+        self._path = path
+
+    def load(self):
+        """
+        :return: dictionary of module states, empty if no checkpoint exists
+        """
+        if not self._path or not os.path.isfile(self._path):
+            return {}
+        try:
+            with open(self._path) as checkpoint:
+                state = json.load(checkpoint)
+            self._logger.info("Checkpoint: Loaded device state from %s (%d seconds old)" %
+                              (self._path, time.time() - state.get('timestamp', 0)))
+            return state.get('modules', {})
+        except (IOError, ValueError), e:
+            self._logger.error("Checkpoint: Error loading %s: %s" % (self._path, e))
+            return {}
+
+    def save(self, modules):
+        """
+        :param modules: dictionary of discover modules by name
+        """
+        if not self._path:
+            return
+        state = {'timestamp': time.time(), 'modules': {}}
+        for name, module in modules.items():
+            if module is not None:
+                state['modules'][name] = module.state()
+        try:
+            with open(self._path + '.tmp', 'w') as checkpoint:
+                json.dump(state, checkpoint, separators=(',', ':'))
+            os.rename(self._path + '.tmp', self._path)
+            self._logger.debug("Checkpoint: Saved device state to %s" % self._path)
+        except (IOError, OSError), e:
+            self._logger.error("Checkpoint: Error saving %s: %s" % (self._path, e))
+
+    def restore(self, modules, state=None):
+        """
+        Restore the saved state of the discover modules
+        """
+        if state is None:
+            state = self.load()
+        for name, module in modules.items():
+            if module is not None and name in state:
+                module.restore(state[name])
+
+    @property
+    def path(self): return self._path
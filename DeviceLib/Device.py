@@ -8,14 +8,25 @@
 import logging
 import time
 import copy
+import sys
 
-class Device:
+from Metrics import metrics
 
-    def __init__(self, logger, config):
+_callback_latency = metrics.histogram('devicedaemon_callback_seconds', 'Device callback latency', ['event'])
+
+class Device(object):
+    """
+    Compact device state: slots instead of an instance dictionary and a
+    reference to the (shared) device configuration
+    """
+
+    __slots__ = ('_logger', '_key', '_timestamp', '_online', '_zone', '_update', '_config')
+
+    def __init__(self, logger, config, key=None):
 
         assert isinstance(logger, logging.Logger)
         self._logger = logger
-        self._key = config['key']
+        self._key = config['key'] if key is None else key
 
         # self._address = address
         # self._name = name
@@ -31,10 +42,13 @@ class Device:
 
         if 'callback' in self._config and key in self._config['callback']:
             if callable(self._config['callback'][key]):
+                started = time.time()
                 try:
                     return self._config['callback'][key](self)
                 except:
                     self._logger.exception("Callback [%s] throwed exception!" % (self._config['callback'][key].__name__))
+                finally:
+                    _callback_latency.labels(key).observe(time.time() - started)
             else:
                 self._logger.error("Invalid callback specification [%s]" % (self._config['callback'][key]))
         else:
@@ -54,10 +68,24 @@ class Device:
             return self._config[key]
         return None
 
+    def state(self):
+        """
+        :return: dictionary with the persistent device state
+        """
+        return {'online': self._online, 'timestamp': self._timestamp, 'zone': self._zone}
+
+    def restore(self, state):
+        self._online = state.get('online')
+        self._timestamp = state.get('timestamp', 0)
+        self._zone = state.get('zone')
+
 # region Properties
     @property
     def key(self): return self._key
 
+    @property
+    def timestamp(self): return self._timestamp
+
     @property
     def age(self): return time.time() - self._timestamp
 
@@ -92,3 +120,35 @@ if __name__ == '__main__':
 
     dev = Device(logging.getLogger(), {'key': 'device',  })
     logging.debug("Device object [%s] created!", dev._key)
+
+    # memory benchmark: dictionary based device with a private config copy vs. slotted device
+    class DictDevice:
+
+        def __init__(self, logger, config):
+            self._logger = logger
+            self._key = config['key']
+            self._timestamp = 0
+            self._online = None
+            self._zone = None
+            self._update = None
+            self._config = copy.deepcopy(config)
+
+    def size(obj):
+        total = sys.getsizeof(obj)
+        if hasattr(obj, '__dict__'):
+            total += sys.getsizeof(obj.__dict__)
+        return total
+
+    count = 10000
+    logger = logging.getLogger()
+    shared = {'callback': {'new': None, 'off': None}}
+    dict_devices = [DictDevice(logger, {'key': '00:11:22:33:%02X:%02X' % (n >> 8 & 0xFF, n & 0xFF),
+                                        'bt': '00:11:22:33:%02X:%02X' % (n >> 8 & 0xFF, n & 0xFF),
+                                        'display': 'Device %d' % n,
+                                        'callback': {'new': None, 'off': None}}) for n in range(count)]
+    slot_devices = [Device(logger, shared, '00:11:22:33:%02X:%02X' % (n >> 8 & 0xFF, n & 0xFF)) for n in range(count)]
+
+    dict_bytes = sum(size(d) + sys.getsizeof(d._config) + sys.getsizeof(d._config['callback']) for d in dict_devices)
+    slot_bytes = sum(size(d) for d in slot_devices)
+    logging.info("%d dict devices: %d KB, %d slotted devices: %d KB (%.1f%%)" %
+                 (count, dict_bytes / 1024, count, slot_bytes / 1024, 100.0 * slot_bytes / dict_bytes))
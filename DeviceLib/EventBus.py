@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+"""
+    asynchronous delivery of device events to pluggable sinks
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import os
+import errno
+import threading
+import collections
+import logging
+import Queue
+import json
+import time
+import requests
+
+from Metrics import metrics
+
+_delivery = metrics.histogram('devicedaemon_event_delivery_seconds', 'Event latency from publish to delivery',
+                              ['sink'])
+_delivered = metrics.counter('devicedaemon_events_delivered_total', 'Events delivered per sink', ['sink'])
+_errors = metrics.counter('devicedaemon_event_errors_total', 'Failed event deliveries per sink', ['sink'])
+_dropped = metrics.counter('devicedaemon_events_dropped_total', 'Events dropped by full queues', ['queue'])
+
+
+def _items(value):
+    """
+    :return: list of the non-empty items of a comma separated option
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return [item.strip() for item in value if item.strip()]
+
+
+class Event(collections.namedtuple('Event', ['name', 'key', 'data', 'payload', 'timestamp'])):
+    """
+    Device event, e.g. ping.new with the device state as data. The payload
+    is the original callback argument and is only passed to callback sinks.
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def create(name, payload=None, data=None):
+        key = None
+        if data is None:
+            if hasattr(payload, 'state'):
+                data = payload.state()
+            elif isinstance(payload, (list, tuple)):
+                # batch of transitions
+                data = [dict(t.device.state(), event=t.event) for t in payload if hasattr(t, 'device')]
+            else:
+                data = {}
+        if hasattr(payload, 'key'):
+            key = payload.key
+        return Event(name, key, data, payload, time.time())
+
+    def json(self):
+        return json.dumps({'event': self.name, 'key': self.key, 'timestamp': self.timestamp, 'data': self.data},
+                          separators=(',', ':'), default=str)
+
+
+class BoundedQueue:
+    """
+    Queue with a maximum size and a policy for a full queue: block the
+    producer, drop the new event (drop_new) or the oldest one (drop_old)
+    """
+
+    policies = ['block', 'drop_new', 'drop_old']
+
+    def __init__(self, name, size, policy='drop_old'):
+        if policy not in self.policies:
+            raise ValueError("Invalid queue policy [%s]" % policy)
+        self._name = name
+        self._policy = policy
+        self._queue = Queue.Queue(size)
+
+    def put(self, event):
+        """
+        :return: False, if an event was dropped
+        """
+        if self._policy == 'block':
+            self._queue.put(event)
+            return True
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                return True
+            except Queue.Full:
+                _dropped.labels(self._name).inc()
+                if self._policy == 'drop_new':
+                    return False
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                pass
+
+    def get(self, timeout=1):
+        """
+        :return: next event or None after timeout seconds
+        """
+        try:
+            return self._queue.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def qsize(self):
+        return self._queue.qsize()
+
+
+class EventSink(threading.Thread):
+    """
+    Deliver events on a worker thread. Subclasses implement deliver(event)
+    or deliver_all(events) for batches of events collected within window seconds.
+    """
+
+    def __init__(self, logger, name, options, policy=None, window=0, batch=1):
+
+        threading.Thread.__init__(self, name="EventSink-%s" % name)
+        self._logger = logger
+        self._name = name
+        self._queue = BoundedQueue(name, int(options.get('queue', 1000)), policy or options.get('policy', 'drop_old'))
+        self._window = window
+        self._batch = batch
+        self._shutdown = False
+
+    def put(self, event):
+        return self._queue.put(event)
+
+    def deliver(self, event):
+        raise NotImplementedError
+
+    def deliver_all(self, events):
+        for event in events:
+            self.deliver(event)
+
+    def collect(self):
+        """
+        :return: list of the next events, empty after a timeout
+        """
+        event = self._queue.get()
+        if event is None:
+            return []
+        events = [event]
+        deadline = time.time() + self._window
+        while len(events) < self._batch:
+            wait = deadline - time.time()
+            if wait <= 0:
+                break
+            event = self._queue.get(wait)
+            if event is None:
+                break
+            events.append(event)
+        return events
+
+    def run(self):
+        self._logger.info("Event sink [%s] started ..." % self._name)
+        while not self._shutdown:
+            events = self.collect()
+            if not events:
+                continue
+            try:
+                self.deliver_all(events)
+                _delivered.labels(self._name).inc(len(events))
+            except Exception, e:
+                _errors.labels(self._name).inc(len(events))
+                self._logger.error("Event sink [%s] failed to deliver %d event(s): %s" % (self._name, len(events), e))
+            now = time.time()
+            for event in events:
+                _delivery.labels(self._name).observe(now - event.timestamp)
+        self.close()
+        self._logger.info("Event sink [%s] stopped!" % self._name)
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        self._shutdown = True
+
+    @property
+    def sink(self): return self._name
+
+
+class LoggerSink(EventSink):
+
+    def __init__(self, logger, options):
+        EventSink.__init__(self, logger, 'log', options)
+
+    def deliver(self, event):
+        self._logger.info("Event: %s [%s] %s" % (event.name, event.key, json.dumps(event.data, default=str)))
+
+
+class FileSink(EventSink):
+    """
+    Append events as JSON lines to a file
+    """
+
+    def __init__(self, logger, options):
+        EventSink.__init__(self, logger, 'file', options)
+        self._path = options['file']
+        self._file = None
+
+    def deliver(self, event):
+        if self._file is None:
+            self._file = open(self._path, 'a')
+        self._file.write(event.json() + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class FifoSink(EventSink):
+    """
+    Write events as JSON lines to a named pipe. Events are discarded
+    while no reader has the pipe open.
+    """
+
+    def __init__(self, logger, options):
+        EventSink.__init__(self, logger, 'fifo', options)
+        self._path = options['fifo']
+        self._fifo = None
+
+    def deliver(self, event):
+        if self._fifo is None:
+            if not os.path.exists(self._path):
+                os.mkfifo(self._path)
+            try:
+                self._fifo = os.open(self._path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # no reader
+                    return
+                raise
+        try:
+            os.write(self._fifo, event.json() + '\n')
+        except OSError, e:
+            self.close()
+            if e.errno not in (errno.EPIPE, errno.EAGAIN):
+                raise
+
+    def close(self):
+        if self._fifo is not None:
+            os.close(self._fifo)
+            self._fifo = None
+
+
+class WebhookSink(EventSink):
+    """
+    Post the events collected within the batch window as JSON array to all
+    webhook urls. A pooled session keeps the connections alive, failed
+    posts are retried with exponential backoff. Events are dropped instead
+    of blocking the dispatcher if the urls do not keep up.
+    """
+
+    def __init__(self, logger, options):
+        EventSink.__init__(self, logger, 'webhook', options, 'drop_old',
+                           float(options.get('webhook_window', 500)) / 1000, int(options.get('webhook_batch', 100)))
+        self._urls = _items(options['webhook'])
+        if not self._urls:
+            raise ValueError("No webhook url configured")
+        self._timeout = int(options.get('webhook_timeout', 5))
+        self._retry = int(options.get('webhook_retry', 3))
+        self._backoff = float(options.get('webhook_backoff', 1))
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self._urls), pool_maxsize=len(self._urls))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session.headers['Content-Type'] = 'application/json'
+
+    def deliver_all(self, events):
+        body = '[%s]' % ','.join(event.json() for event in events)
+        failed = [url for url in self._urls if not self._post(url, body)]
+        if failed:
+            raise IOError("Post to %s failed" % ', '.join(failed))
+
+    def _post(self, url, body):
+        for attempt in range(self._retry + 1):
+            if attempt:
+                time.sleep(self._backoff * 2 ** (attempt - 1))
+            try:
+                response = self._session.post(url, data=body, timeout=self._timeout)
+                response.close()
+                if response.status_code < 500:
+                    if response.status_code >= 400:
+                        self._logger.error("Events: Webhook %s rejected events: %d" % (url, response.status_code))
+                        return False
+                    return True
+                self._logger.debug("Events: Webhook %s failed: %d" % (url, response.status_code))
+            except requests.RequestException, e:
+                self._logger.debug("Events: Webhook %s failed: %s" % (url, e))
+            if self._shutdown:
+                break
+        return False
+
+    def close(self):
+        self._session.close()
+
+
+class CallbackSink(EventSink):
+    """
+    Call a handler function with the event payload, e.g. the controller
+    callbacks: handlers then run on the sink thread instead of the probes
+    """
+
+    def __init__(self, logger, options, handlers):
+        EventSink.__init__(self, logger, 'callback', options)
+        self._handlers = handlers
+
+    def deliver(self, event):
+        handler = self._handlers.get(event.name)
+        if handler is not None:
+            handler(event.payload)
+
+
+class EventBus(threading.Thread):
+    """
+    Producers publish events into a bounded queue, the dispatcher thread
+    hands them over to the queues of all sinks
+    """
+
+    sinks = {'log': LoggerSink, 'file': FileSink, 'fifo': FifoSink, 'webhook': WebhookSink}
+
+    def __init__(self, logger, options, sinks=None):
+
+        threading.Thread.__init__(self, name="EventBus")
+        assert isinstance(logger, logging.Logger)
+        self._logger = logger
+        self._queue = BoundedQueue('bus', int(options['queue']), options['policy'])
+        self._sinks = [] if sinks is None else list(sinks)
+        for name in _items(options.get('sinks')):
+            if name in self.sinks:
+                try:
+                    self._sinks.append(self.sinks[name](self._logger, options))
+                except ValueError, e:
+                    self._logger.error("Events: Sink [%s] disabled: %s" % (name, e))
+            else:
+                self._logger.error("Events: Unknown sink [%s]" % name)
+        self._shutdown = False
+
+    def publish(self, name, payload=None, data=None):
+        """
+        Queue an event: called from the probing threads
+        """
+        return self._queue.put(Event.create(name, payload, data))
+
+    def dispatch(self, event):
+        for sink in self._sinks:
+            sink.put(event)
+
+    def start(self):
+        for sink in self._sinks:
+            sink.start()
+        threading.Thread.start(self)
+
+    def run(self):
+        self._logger.info("Event bus started with sinks %s ..." % [sink.sink for sink in self._sinks])
+        while not self._shutdown:
+            event = self._queue.get()
+            if event is not None:
+                self.dispatch(event)
+        self._logger.info("Event bus stopped!")
+
+    def shutdown(self):
+        self._shutdown = True
+        for sink in self._sinks:
+            sink.shutdown()
+
+    @property
+    def pending(self): return self._queue.qsize()
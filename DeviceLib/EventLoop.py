@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+    single threaded event loop for file descriptors and timers
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import os
+import errno
+import fcntl
+import select
+import heapq
+import collections
+import threading
+import logging
+import time
+
+from Metrics import metrics
+
+_iteration = metrics.histogram('devicedaemon_loop_iteration_seconds', 'Event loop iteration time without waiting')
+
+
+def _fileno(fileobj):
+    return fileobj if isinstance(fileobj, (int, long)) else fileobj.fileno()
+
+
+class _EpollPoller:
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def register(self, fd):
+        self._epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+
+    def unregister(self, fd):
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        return [fd for fd, event in self._epoll.poll(-1 if timeout is None else timeout)]
+
+    def close(self):
+        self._epoll.close()
+
+
+class _PollPoller:
+
+    def __init__(self):
+        self._poll = select.poll()
+
+    def register(self, fd):
+        self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def unregister(self, fd):
+        try:
+            self._poll.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout):
+        return [fd for fd, event in self._poll.poll(None if timeout is None else timeout * 1000)]
+
+    def close(self):
+        pass
+
+
+class _SelectPoller:
+
+    def __init__(self):
+        self._fds = set()
+
+    def register(self, fd):
+        self._fds.add(fd)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+
+    def poll(self, timeout):
+        return select.select(list(self._fds), [], [], timeout)[0]
+
+    def close(self):
+        pass
+
+
+class EventLoop:
+    """
+    Dispatch readable file descriptors and timers from one thread. Uses
+    epoll where available, so the number of descriptors is not limited
+    by FD_SETSIZE. Other threads hand over work with call_soon_threadsafe(),
+    signal handlers with call_soon_signalsafe().
+    """
+
+    _pollers = [('epoll', _EpollPoller), ('poll', _PollPoller), ('select', _SelectPoller)]
+
+    def __init__(self, logger, poller='auto'):
+
+        assert isinstance(logger, logging.Logger)
+        self._logger = logger
+        self._poller = None
+        self._poller_name = None
+
+        for name, cls in self._pollers:
+            if poller in ('auto', name) and hasattr(select, name):
+                self._poller = cls()
+                self._poller_name = name
+                break
+
+        if self._poller is None:
+            raise ValueError("Poller [%s] not available" % poller)
+
+        self._readers = {}      # fd -> (callback, args)
+        self._timers = []       # heap of [when, sequence, callback, args]
+        self._sequence = 0
+        self._pending = []
+        self._signalled = collections.deque()
+        self._lock = threading.Lock()
+        self._running = False
+
+        # self pipe to wake up the poller from other threads
+        (self._wakeup_read, self._wakeup_write) = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.add_reader(self._wakeup_read, self._drain)
+
+    def add_reader(self, fileobj, callback, *args):
+        fd = _fileno(fileobj)
+        if fd in self._readers:
+            self._poller.unregister(fd)
+        self._readers[fd] = (callback, args)
+        self._poller.register(fd)
+
+    def remove_reader(self, fileobj):
+        fd = _fileno(fileobj)
+        if fd in self._readers:
+            del self._readers[fd]
+            self._poller.unregister(fd)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedule a callback
+        :return: timer handle for cancel()
+        """
+        self._sequence += 1
+        timer = [time.time() + delay, self._sequence, callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None:
+            timer[2] = None
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self._lock:
+            self._pending.append((callback, args))
+        self._wakeup()
+
+    def call_soon_signalsafe(self, callback, *args):
+        """
+        Schedule a callback from a signal handler. Signal handlers run on the
+        loop thread and may interrupt run_once() while it holds the lock, so
+        the callback is queued without locking.
+        """
+        self._signalled.append((callback, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError:
+            pass
+
+    def _drain(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            self._logger.exception("Event loop callback [%s] throwed exception!" %
+                                   getattr(callback, '__name__', callback))
+
+    def _timeout(self):
+        if self._pending or self._signalled:
+            return 0
+        if not self._timers:
+            return None
+        return max(self._timers[0][0] - time.time(), 0)
+
+    def run_once(self):
+
+        try:
+            fds = self._poller.poll(self._timeout())
+        except (IOError, OSError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            fds = []
+
+        started = time.time()
+        for fd in fds:
+            if fd in self._readers:
+                (callback, args) = self._readers[fd]
+                self._run_callback(callback, args)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            (when, sequence, callback, args) = heapq.heappop(self._timers)
+            if callback is not None:
+                self._run_callback(callback, args)
+
+        with self._lock:
+            (pending, self._pending) = (self._pending, [])
+        for callback, args in pending:
+            self._run_callback(callback, args)
+
+        while self._signalled:
+            (callback, args) = self._signalled.popleft()
+            self._run_callback(callback, args)
+
+        _iteration.observe(time.time() - started)
+
+    def run(self):
+        self._logger.info("Event loop started using %s ..." % self._poller_name)
+        self._running = True
+        while self._running:
+            self.run_once()
+        self._logger.info("Event loop stopped!")
+
+    def stop(self):
+        self._running = False
+        self.call_soon_threadsafe(lambda: None)
+
+    def close(self):
+        self.remove_reader(self._wakeup_read)
+        self._poller.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    @property
+    def running(self): return self._running
+
+    @property
+    def poller(self): return self._poller_name
@@ -11,6 +11,11 @@ from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from SocketServer import ThreadingMixIn
 import threading
 import select
+import Queue
+import json
+import collections
+import socket
+import math
 
 from urlparse import urlparse, parse_qs
 # import time
@@ -21,6 +26,10 @@ from urlparse import urlparse, parse_qs
 # import socket
 
 from Device import *
+from Registry import DeviceRegistry
+from Metrics import metrics
+
+_request_latency = metrics.histogram('devicedaemon_http_request_seconds', 'Http request latency', ['method'])
 
 
 class HttpDevice(Device):
@@ -34,6 +43,17 @@ class HttpDevice(Device):
     def check(self, callback):
         return True
 
+    def state(self):
+        state = Device.state(self)
+        # update is an instance attribute after the first zone update
+        state['update'] = None if callable(self.update) else self.update
+        return state
+
+    def restore(self, state):
+        Device.restore(self, state)
+        if state.get('update') is not None:
+            self.update = state['update']
+
     @property
     def serial(self): return Device.config(self,'serial')
 
@@ -41,25 +61,191 @@ class HttpDevice(Device):
     def name(self): return Device.config(self,'display')
 
 
+class EventStream:
+    """
+    Ring buffer of the latest device events for server-sent event streams
+    and long-poll requests. Event ids start at the current time in
+    milliseconds, so clients can resume across daemon restarts.
+    """
+
+    def __init__(self, size=256):
+        self._events = collections.deque(maxlen=size)   # (id, name, data)
+        self._last = int(time.time() * 1000)
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, name, data):
+        """
+        :param data: event as JSON string
+        """
+        with self._condition:
+            self._last += 1
+            self._events.append((self._last, name, data))
+            self._condition.notify_all()
+
+    def since(self, last, wait=0):
+        """
+        :param last: id of the last event received by the client
+        :param wait: seconds to wait for new events
+        :return: list of buffered (id, name, data) tuples newer than last
+        """
+        deadline = time.time() + wait
+        with self._condition:
+            while self._last <= last and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return [event for event in self._events if event[0] > last]
+
+    def open(self):
+        self._closed = False
+
+    def close(self):
+        """
+        Wake up and end all waiting streams
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    @property
+    def closed(self): return self._closed
+
+    @property
+    def last(self): return self._last
+
+
 class HttpRequestHandler(BaseHTTPRequestHandler):
 
+    # set by stream_events when the client closed the connection
+    disconnected = False
+
     def do_HEAD(self):
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.end_headers()
 
+    def setup(self):
+        if self.server.keepalive:
+            # persistent HTTP/1.1 connections, closed after an idle timeout
+            self.protocol_version = 'HTTP/1.1'
+            self.timeout = self.server.keepalive
+        BaseHTTPRequestHandler.setup(self)
+
+    # the socket file keeps unsent data of a disconnected event stream
+    # and fails again when it is flushed after the request and on close
+
+    def handle_one_request(self):
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        except socket.error:
+            if not self.disconnected:
+                raise
+            self.close_connection = 1
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            if not self.disconnected:
+                raise
+            self.rfile.close()
+
+    def send_message(self, response, message, content_type="text/plain"):
+        message += '\n'
+        self.send_response(response)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
     def do_GET(self):
         # OPTS= self.server.options
+        started = time.time()
+        if urlparse(self.path).path == '/metrics':
+            self.send_message(200, metrics.render(), "text/plain; version=0.0.4")
+            return
         GET = parse_qs(urlparse(self.path).query)
-        if GET:
-            (response, message) = self.server.discover.process_get_request(GET, self)
-            self.send_response(response)
-            self.send_header("Content-type", "text/plain")
+        if urlparse(self.path).path.rstrip('/') == '/events':
+            # streams and long-polls hold a worker: keep workers for zone updates
+            streams = self.server.streams
+            if streams is not None and not streams.acquire(False):
+                self.send_message(503, "Too many event streams")
+                return
+            try:
+                if 'since' in GET:
+                    self.poll_events(GET)
+                else:
+                    self.stream_events()
+            finally:
+                if streams is not None:
+                    streams.release()
+            return
+        # tuple (response, message) with an optional content type
+        self.send_message(*self.server.discover.process_get_request(GET, self))
+        _request_latency.labels('GET').observe(time.time() - started)
+        # self.wfile.write(threading.current_thread().getName())
+        # self.wfile.write('\n')
+
+    def poll_events(self, request):
+        """
+        Long-poll: events after the id of the since parameter as JSON, waiting
+        up to wait seconds (max. 60) for new events
+        """
+        try:
+            last = int(request['since'][0])
+            wait = float(request['wait'][0]) if 'wait' in request else 0
+            if math.isnan(wait) or math.isinf(wait) or wait < 0:
+                raise ValueError(wait)
+            wait = min(wait, 60)
+        except ValueError:
+            self.send_message(400, "Invalid since or wait parameter")
+            return
+        events = self.server.discover.stream.since(last, wait)
+        message = '{"last":%d,"events":[%s]}' % (events[-1][0] if events else max(last, 0),
+                                                 ','.join('{"id":%d,"event":%s}' % (event[0], event[2])
+                                                          for event in events))
+        self.send_message(200, message, "application/json")
+
+    def stream_events(self):
+        """
+        Server-sent events: push events until the client disconnects. A client
+        resumes after the id of the Last-Event-ID header. Idle streams get a
+        comment every 15 seconds to detect closed connections.
+        """
+        stream = self.server.discover.stream
+        try:
+            last = int(self.headers.getheader('Last-Event-ID', stream.last))
+        except ValueError:
+            last = stream.last
+        self.close_connection = 1
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
             self.end_headers()
-            self.wfile.write(message)
-            self.wfile.write('\n')
-            # self.wfile.write(threading.current_thread().getName())
-            # self.wfile.write('\n')
+            self.wfile.write("retry: 5000\n\n")
+            self.wfile.flush()
+            while not stream.closed:
+                events = stream.since(last, 15)
+                if not events and not stream.closed:
+                    self.wfile.write(": keepalive\n\n")
+                for (last, name, data) in events:
+                    self.wfile.write("id: %d\nevent: %s\ndata: %s\n\n" % (last, name, data))
+                self.wfile.flush()
+        except socket.error:
+            # client disconnected
+            self.disconnected = True
+
+    def do_POST(self):
+        started = time.time()
+        length = int(self.headers.getheader('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else ''
+        (response, message) = self.server.discover.process_post_request(body, self)
+        self.send_message(response, message, "application/json")
+        _request_latency.labels('POST').observe(time.time() - started)
 
     def log_message(self, format, *args):
         # disable default logging of get request
@@ -70,14 +256,62 @@ class HttpServer(ThreadingMixIn, HTTPServer):
     Helper class to pass options to the request handler
     """
 
-    def __init__(self, server, handler, discover):
+    def __init__(self, server, handler, discover, backlog=5, keepalive=0):
         self.discover = discover
+        self.request_queue_size = backlog
+        self.keepalive = keepalive
+        # a thread per request: event streams are not limited
+        self.streams = None
         HTTPServer.__init__(self, server, handler)
 
         # @property
         # def options(self): return self._options
 
 
+class PooledHttpServer(HTTPServer):
+    """
+    Handle requests in a fixed pool of worker threads instead of
+    starting a new thread for every request
+    """
+
+    def __init__(self, server, handler, discover, pool=4, backlog=5, keepalive=0):
+        self.discover = discover
+        self.request_queue_size = backlog
+        self.keepalive = keepalive
+        # event streams and long-polls may use all workers but one
+        self.streams = threading.Semaphore(max(pool - 1, 0))
+        HTTPServer.__init__(self, server, handler)
+
+        self._requests = Queue.Queue()
+        self._workers = []
+        for number in range(pool):
+            worker = threading.Thread(target=self._worker, name="HttpWorker-%d" % number)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+                self.shutdown_request(request)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for worker in self._workers:
+            self._requests.put(None)
+
+
 class HttpDiscoverDevice:
 
     _update = {'0': 0, 'exit': 0, 'leave': 0, 'left': 0, 'out': '0', 'checkout': '0',
@@ -96,21 +330,72 @@ class HttpDiscoverDevice:
         self._callback = options['callback']
         self._port = int(options['port'])
         self._host = options['host']
+        self._pool = int(options.get('pool', 0))
+        self._backlog = int(options.get('backlog', 5))
+        self._keepalive = int(options.get('keepalive', 0))
         self._httpd = None
         self._socket = None
         self._devices = {}
+        self._registry = DeviceRegistry.wrap(devices)
+        self._key = options['key']
+        self._stream = EventStream(int(options.get('stream', 256)))
+
+        for dev in options['devices']:
+            self._register(self._devices, dev)
+
+    def _register(self, devices, dev):
+        if dev in self._registry:
+            device = self._registry.config(dev)
+            if 'callback' not in device:
+                device['callback'] = self._callback
+            key = self._key
+            if key in device:
+                id = device[key]
+                devices[id] = HttpDevice(self._logger, device)
+                self._logger.info("Device [%s] with %s [%s] registered for http requests!" %
+                                  (devices[id].key, key, devices[id].config(key)))
+                return devices[id]
+        return None
+
+    def reload(self, options, changed):
+        """
+        Register added and changed devices, drop removed ones
+        :param options: new options of the http section
+        :param changed: keys of added, removed or changed device configurations
+        :return: True, if the server was closed for changed server options
+        """
+        relisten = False
+        for option in ['host', 'port', 'pool', 'backlog', 'keepalive']:
+            if option in options and str(options[option]) != str(getattr(self, '_' + option)):
+                relisten = True
+        if relisten:
+            self.close()
+            self._host = options['host']
+            self._port = int(options['port'])
+            self._pool = int(options.get('pool', 0))
+            self._backlog = int(options.get('backlog', 5))
+            self._keepalive = int(options.get('keepalive', 0))
+
+        rebuild = options['key'] != self._key
+        self._key = options['key']
 
+        current = dict((device.key, device) for device in self._devices.values())
+        devices = {}
         for dev in options['devices']:
-            if dev in devices:
-                device = copy.deepcopy(devices[dev])
-                if 'callback' not in device:
-                    device['callback'] = options['callback']
-                key = options['key']
-                if key in device:
-                    id = device[key]
-                    self._devices[id] = HttpDevice(self._logger, device)
-                    self._logger.info("Device [%s] with %s [%s] registered for http requests!" %
-                                     (self._devices[id].key, key, self._devices[id].config(key)))
+            if dev in current and dev not in changed and not rebuild:
+                devices[current[dev].config(self._key)] = current[dev]
+            else:
+                device = self._register(devices, dev)
+                if device is not None and dev in current:
+                    device.restore(current[dev].state())
+
+        for dev in current:
+            if dev not in options['devices']:
+                self._logger.info("Device [%s] unregistered for http requests!" % dev)
+
+        # replace the map at once: requests are processed by other threads
+        self._devices = devices
+        return relisten
 
     def process_get_request(self, request, handler):
 
@@ -125,13 +410,71 @@ class HttpDiscoverDevice:
                     if 'update' in request and len(request['update']) == 1:
                         update = request['update'][0]
                         if update in self._update:
-                            self._devices[key].zone = zone
-                            self._devices[key].update = self._update[update]
-                            return Device.callback(self._devices[key], 'update')
+                            return self.process_zone_update(key, zone, update)
 
         # process other get requests
         return self._callback['request'](request, handler)
 
+    def process_zone_update(self, key, zone, update):
+        """
+        Set zone of a registered device and call the update callback
+        :return: tuple (response, message)
+        """
+        if key not in self._devices:
+            return 404, "Unknown device [%s]" % key
+        if update not in self._update:
+            return 400, "Invalid update [%s]" % update
+        Device.update(self._devices[key])
+        self._devices[key].zone = zone
+        self._devices[key].update = self._update[update]
+        result = Device.callback(self._devices[key], 'update')
+        if result is None:
+            return 500, "No callback for zone updates"
+        return result
+
+    def process_post_request(self, body, handler):
+        """
+        Process a batch of zone updates posted as JSON array or as
+        newline delimited JSON objects with device, zone and update keys
+        :return: tuple (response, message) with per item status as JSON array
+        """
+        assert isinstance(handler, HttpRequestHandler)
+
+        if urlparse(handler.path).path != '/zones':
+            return 404, json.dumps({'status': 404, 'message': "Invalid path [%s]" % handler.path})
+
+        try:
+            body = body.strip()
+            if body.startswith('['):
+                items = json.loads(body)
+            else:
+                items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        except ValueError, e:
+            return 400, json.dumps({'status': 400, 'message': "Invalid request: %s" % e})
+
+        result = []
+        for item in items:
+            if not isinstance(item, dict) or not all(key in item for key in ('device', 'zone', 'update')):
+                (response, message) = (400, "Item requires device, zone and update")
+            elif not isinstance(item['device'], basestring) or not isinstance(item['zone'], basestring) \
+                    or not isinstance(item['update'], (basestring, int)):
+                (response, message) = (400, "Device and zone must be strings, update a string or number")
+            else:
+                (response, message) = self.process_zone_update(item['device'], item['zone'], str(item['update']))
+            result.append({'device': item.get('device') if isinstance(item, dict) else None,
+                           'status': response, 'message': message})
+
+        self._logger.debug("Http: Processed %d zone updates" % len(result))
+        return 200, json.dumps(result)
+
+    def state(self):
+        return dict((device.key, device.state()) for device in self._devices.values())
+
+    def restore(self, state):
+        for device in self._devices.values():
+            if device.key in state:
+                device.restore(state[device.key])
+
     def __enter__(self):
         return self
 
@@ -143,8 +486,14 @@ class HttpDiscoverDevice:
             self.close()
 
         self._logger.info("Http: Listening at port %s for zone update requests ..." % self._port)
-
-        self._httpd = HttpServer((self._host, self._port), HttpRequestHandler, self)
+        self._stream.open()
+
+        if self._pool > 0:
+            self._httpd = PooledHttpServer((self._host, self._port), HttpRequestHandler, self,
+                                           self._pool, self._backlog, self._keepalive)
+        else:
+            self._httpd = HttpServer((self._host, self._port), HttpRequestHandler, self,
+                                     self._backlog, self._keepalive)
         self._socket = self._httpd.socket;
 
         # self._httpd.serve_forever()
@@ -157,6 +506,7 @@ class HttpDiscoverDevice:
         #         self._httpd.handle_request()
 
     def close(self):
+        self._stream.close()
         if self._httpd is not None:
             self._httpd.server_close()
             self._httpd = None
@@ -170,6 +520,14 @@ class HttpDiscoverDevice:
     def socket(self):
         return self._socket
 
+    @property
+    def devices(self):
+        return self._devices.values()
+
+    @property
+    def stream(self):
+        return self._stream
+
 # region __Main__
 if __name__ == '__main__':
 
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+
+"""
+    multiplexed ICMP echo engine: one socket and one thread for all ping devices
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import os
+import errno
+import socket
+import select
+import struct
+import heapq
+import threading
+import logging
+import time
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+
+def checksum(source):
+    """
+    RFC 1071 internet checksum of a packet string
+    """
+    if len(source) % 2:
+        source += '\0'
+    total = sum(struct.unpack('!%dH' % (len(source) // 2), source))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += (total >> 16)
+    return ~total & 0xFFFF
+
+
+def echo_request(ident, sequence, psize):
+    """
+    Build an ICMP echo request packet
+    """
+    payload = 'Q' * max(psize - 8, 0)
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, sequence)
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum(header + payload), ident, sequence)
+    return header + payload
+
+
+def echo_reply(packet, raw=True):
+    """
+    Parse an ICMP echo reply
+    :param packet: received packet, including the ip header for raw sockets
+    :return: tuple (ident, sequence) or None if packet is not an echo reply
+    """
+    offset = (ord(packet[0]) & 0x0F) * 4 if raw else 0
+    if len(packet) < offset + 8:
+        return None
+    (kind, code, csum, ident, sequence) = struct.unpack('!BBHHH', packet[offset:offset + 8])
+    if kind != ICMP_ECHO_REPLY:
+        return None
+    return ident, sequence
+
+
+def icmp_socket(privileged=None):
+    """
+    Open an ICMP socket: a raw socket when running as root, otherwise an
+    unprivileged datagram socket (requires net.ipv4.ping_group_range)
+    :return: tuple (socket, raw)
+    """
+    if privileged is None:
+        privileged = os.geteuid() == 0
+
+    if privileged:
+        icmp = socket.getprotobyname("icmp")
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp), True
+        except socket.error, (code, msg):
+            if code == errno.EPERM:
+                # Operation not permitted
+                msg += " - Note that ICMP messages can only be sent from processes running as root"
+                raise socket.error(msg)
+            raise
+
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+    except socket.error, (code, msg):
+        if code in (errno.EACCES, errno.EPERM):
+            msg += " - Check net.ipv4.ping_group_range for unprivileged ICMP sockets"
+            raise socket.error(msg)
+        raise
+
+
+def cidr_hosts(cidr):
+    """
+    Host addresses of an IPv4 network in CIDR notation, e.g. 192.168.1.0/24.
+    Network and broadcast addresses are excluded for prefixes up to /30.
+    :return: list of addresses
+    """
+    (address, slash, prefix) = cidr.strip().partition('/')
+    prefix = int(prefix) if slash else 32
+    if not 0 <= prefix <= 32:
+        raise ValueError("Invalid network prefix [%s]" % cidr)
+    try:
+        network = struct.unpack('!I', socket.inet_aton(address))[0]
+    except socket.error:
+        raise ValueError("Invalid network address [%s]" % cidr)
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    first = network & mask
+    last = first | (~mask & 0xFFFFFFFF)
+    if prefix <= 30:
+        first += 1
+        last -= 1
+    return [socket.inet_ntoa(struct.pack('!I', host)) for host in xrange(first, last + 1)]
+
+
+def ping_once(sock, raw, ident, sequence, address, psize, timeout):
+    """
+    Send one echo request on a blocking socket and wait for the reply.
+    Datagram sockets get the ICMP id assigned by the kernel, so replies
+    are matched by sequence only.
+    :return: delay in seconds or None on timeout
+    """
+    sent = time.time()
+    sock.sendto(echo_request(ident, sequence, psize), (address, 1))
+    deadline = sent + timeout
+    while True:
+        wait = deadline - time.time()
+        if wait <= 0:
+            return None
+        if not select.select([sock], [], [], wait)[0]:
+            return None
+        reply = echo_reply(sock.recv(2048), raw)
+        if reply is None:
+            continue
+        if raw and reply[0] != ident:
+            continue
+        if reply[1] == sequence:
+            return time.time() - sent
+
+
+class Sweep:
+    """
+    Rate limited echo requests to a list of addresses, repeated every interval seconds
+    """
+
+    def __init__(self, addresses, rate, timeout, interval, reply, done):
+        self.addresses = addresses
+        self.rate = rate
+        self.timeout = timeout
+        self.interval = interval
+        self.reply = reply          # called with address and delay of every reply
+        self.done = done            # called with the set of responding addresses
+        self.due = time.time()
+        self.reset()
+
+    def reset(self):
+        self.started = None
+        self.sent = 0
+        self.last = None
+        self.alive = set()
+        self.pending = {}           # sequence -> (address, sent)
+
+
+class IcmpEngine(threading.Thread):
+    """
+    Send echo requests to all registered ping devices from a single socket
+    and demultiplex the replies by ICMP id/sequence in one receive loop.
+    Devices keep their own probe interval, timeout/retry settings and callbacks.
+    """
+
+    def __init__(self, logger, options):
+
+        threading.Thread.__init__(self)
+        self._logger = logger
+        self._options = options
+        self._ident = os.getpid() & 0xFFFF
+        self._sequence = 0
+        self._socket = None
+        self._raw = True
+        self._devices = {}
+        self._schedule = []     # heap of (due, key, device)
+        self._deadlines = []    # heap of (deadline, sequence)
+        self._pending = {}      # sequence -> [device, sent, deadline, attempt]
+        self._bursts = {}       # key -> remaining confirmation probes of a failed device
+        self._sweep = None
+        self._lock = threading.Lock()
+        self._loop = None
+        self._shutdown = False
+
+    def open(self):
+        (self._socket, self._raw) = icmp_socket()
+        self._socket.setblocking(0)
+        return self._socket
+
+    def register(self, device):
+        with self._lock:
+            self._devices[device.key] = device
+            heapq.heappush(self._schedule, (time.time() + device.offset, device.key, device))
+
+    def unregister(self, device):
+        with self._lock:
+            if self._devices.get(device.key) is device:
+                del self._devices[device.key]
+                self._bursts.pop(device.key, None)
+
+    def sweep(self, addresses, reply, done, rate=1000, timeout=1, interval=0):
+        """
+        Probe all addresses, e.g. the hosts of a subnet, with at most rate
+        echo requests per second. Replies are reported as they arrive.
+        :param reply: function called with address and delay for every reply
+        :param done: function called with the set of responding addresses after the last timeout
+        :param interval: seconds between two sweeps, 0 for a single sweep
+        """
+        if len(addresses) > 0xFFFF:
+            raise ValueError("Sweep of %d addresses exceeds the icmp sequence numbers" % len(addresses))
+        with self._lock:
+            self._sweep = Sweep(addresses, rate, timeout, interval, reply, done)
+
+    def _sweep_send(self, now):
+        sweep = self._sweep
+        if sweep is None or now < sweep.due:
+            return
+        if sweep.started is None:
+            sweep.started = now
+            self._logger.debug("Icmp: Sweeping %d addresses ..." % len(sweep.addresses))
+        allowed = min(len(sweep.addresses), int((now - sweep.started) * sweep.rate) + 1)
+        while sweep.sent < allowed:
+            address = sweep.addresses[sweep.sent]
+            sweep.sent += 1
+            sequence = self._next_sequence()
+            try:
+                self._socket.sendto(echo_request(self._ident, sequence, 64), (address, 1))
+            except socket.error, e:
+                self._logger.debug("Icmp: sweep to [%s] failed: %s" % (address, e))
+                continue
+            sweep.pending[sequence] = (address, now)
+            sweep.last = now
+        if sweep.sent == len(sweep.addresses) and now >= (sweep.last or sweep.started) + sweep.timeout:
+            self._logger.debug("Icmp: Sweep completed in %.2f seconds, %d of %d addresses responding" %
+                               (now - sweep.started, len(sweep.alive), len(sweep.addresses)))
+            alive = sweep.alive
+            if sweep.interval:
+                sweep.due = sweep.started + sweep.interval
+                sweep.reset()
+            else:
+                self._sweep = None
+            try:
+                sweep.done(alive)
+            except:
+                self._logger.exception("Icmp: processing sweep results failed!")
+
+    def _sweep_receive(self, sequence, now):
+        sweep = self._sweep
+        if sweep is None:
+            return
+        target = sweep.pending.pop(sequence, None)
+        if target is not None:
+            sweep.alive.add(target[0])
+            try:
+                sweep.reply(target[0], now - target[1])
+            except:
+                self._logger.exception("Icmp: processing sweep reply of [%s] failed!" % target[0])
+
+    def _next_sequence(self):
+        self._sequence = (self._sequence + 1) & 0xFFFF
+        return self._sequence
+
+    def _send(self, device, attempt=0):
+        now = time.time()
+        if device.ip is None:
+            # address not resolved (yet) or removed by a reload
+            self._complete(device, None, now)
+            return
+        sequence = self._next_sequence()
+        try:
+            self._socket.sendto(echo_request(self._ident, sequence, device.psize), (device.ip, 1))
+        except socket.error, e:
+            self._logger.debug("Icmp: send to [%s] failed: %s" % (device.ip, e))
+            self._complete(device, None, now)
+            return
+        deadline = now + device.timeout
+        self._pending[sequence] = [device, now, deadline, attempt]
+        heapq.heappush(self._deadlines, (deadline, sequence))
+
+    def _complete(self, device, result, now, delay=None):
+        if self._devices.get(device.key) is not device:
+            # device unregistered while the probe was pending
+            return
+        self._bursts.pop(device.key, None)
+        try:
+            device.process(result, delay)
+        except:
+            self._logger.exception("Icmp: processing result for [%s] failed!" % device.key)
+        with self._lock:
+            heapq.heappush(self._schedule, (now + device.interval(), device.key, device))
+
+    def _dispatch(self, now):
+        with self._lock:
+            due = []
+            while self._schedule and self._schedule[0][0] <= now:
+                (key, device) = heapq.heappop(self._schedule)[1:]
+                if self._devices.get(key) is device:
+                    # entries of unregistered devices are dropped, even if the key is registered again
+                    due.append(device)
+        for device in due:
+            try:
+                if device.skip():
+                    # online by the neighbour table
+                    self._bursts.pop(device.key, None)
+                    with self._lock:
+                        heapq.heappush(self._schedule, (now + device.interval(), device.key, device))
+                else:
+                    self._send(device)
+            except:
+                self._logger.exception("Icmp: probing [%s] failed!" % device.key)
+                self._complete(device, None, now)
+
+    def _expire(self, now):
+        while self._deadlines and self._deadlines[0][0] <= now:
+            sequence = heapq.heappop(self._deadlines)[1]
+            probe = self._pending.pop(sequence, None)
+            if probe is None:
+                continue
+            (device, sent, deadline, attempt) = probe
+            try:
+                if attempt + 1 < device.retry:
+                    self._send(device, attempt + 1)
+                else:
+                    self._failed(device, now)
+            except:
+                self._logger.exception("Icmp: probing [%s] failed!" % device.key)
+                self._complete(device, None, now)
+
+    def _failed(self, device, now):
+        """
+        Confirm a failed probe with a burst of probes at the confirm interval
+        before the failure is processed
+        """
+        remaining = self._bursts.pop(device.key, None)
+        if remaining is None:
+            remaining = device.confirm
+        if remaining > 0 and self._devices.get(device.key) is device:
+            self._bursts[device.key] = remaining - 1
+            with self._lock:
+                heapq.heappush(self._schedule, (now + device.confirm_interval, device.key, device))
+        else:
+            self._complete(device, False, now)
+
+    def _receive(self):
+        while True:
+            try:
+                packet = self._socket.recv(2048)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._logger.debug("Icmp: receive failed: %s" % e)
+                return
+            now = time.time()
+            reply = echo_reply(packet, self._raw)
+            if reply is None:
+                continue
+            (ident, sequence) = reply
+            if self._raw and ident != self._ident:
+                continue
+            probe = self._pending.pop(sequence, None)
+            if probe is not None:
+                self._complete(probe[0], True, now, now - probe[1])
+            else:
+                self._sweep_receive(sequence, now)
+
+    def _wait(self, now):
+        wait = 1.0
+        with self._lock:
+            if self._schedule:
+                wait = min(wait, self._schedule[0][0] - now)
+        if self._deadlines:
+            wait = min(wait, self._deadlines[0][0] - now)
+        sweep = self._sweep
+        if sweep is not None:
+            if sweep.started is None:
+                wait = min(wait, sweep.due - now)
+            elif sweep.sent < len(sweep.addresses):
+                wait = min(wait, 1.0 / sweep.rate)
+            else:
+                wait = min(wait, (sweep.last or sweep.started) + sweep.timeout - now)
+        return max(wait, 0)
+
+    def tick(self):
+        """
+        Send due echo requests and expire unanswered ones
+        :return: seconds until the next tick is due
+        """
+        now = time.time()
+        self._dispatch(now)
+        self._expire(now)
+        self._sweep_send(now)
+        return self._wait(time.time())
+
+    def process_event(self):
+        self._receive()
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def attach(self, loop):
+        """
+        Run the engine inside an event loop instead of its own thread
+        """
+        self._logger.info("Icmp engine attached to event loop for %d devices ..." % len(self._devices))
+        self._loop = loop
+        self._loop.add_reader(self._socket, self.process_event)
+        self._loop_tick()
+
+    def _loop_tick(self):
+        if self._shutdown:
+            self._loop.remove_reader(self._socket)
+            self.done()
+            self._logger.info("Icmp engine stopped!")
+            return
+        wait = 1
+        try:
+            wait = self.tick()
+        finally:
+            # keep probing after an exception, it is logged by the event loop
+            self._loop.call_later(wait, self._loop_tick)
+
+    def run(self):
+        self._logger.info("Icmp engine started for %d devices ..." % len(self._devices))
+        while not self._shutdown:
+            try:
+                wait = self.tick()
+            except:
+                self._logger.exception("Icmp: tick failed!")
+                wait = 1
+            try:
+                rfds = select.select([self._socket], [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if rfds:
+                self._receive()
+        self.done()
+        self._logger.info("Icmp engine stopped!")
+
+    def shutdown(self):
+        self._shutdown = True
+
+    def done(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except: pass
+            self._socket = None
+
+    @property
+    def socket(self): return self._socket
+
+    @property
+    def devices(self): return self._devices
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+    low overhead counters and histograms in Prometheus text format
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import thread
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DURATION_BUCKETS = (1.0, 2.5, 5.0, 7.5, 10.0, 12.5, 15.0, 20.0, 30.0, 60.0)
+
+
+class Counter:
+    """
+    Monotonic counter. Every thread increments its own shard, so the
+    hot path needs no lock; shards are summed up when rendered.
+    """
+
+    def __init__(self):
+        self._shards = {}
+
+    def inc(self, amount=1):
+        ident = thread.get_ident()
+        self._shards[ident] = self._shards.get(ident, 0) + amount
+
+    @property
+    def value(self): return sum(self._shards.values())
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets, sharded per thread like the counter
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._shards = {}
+
+    def observe(self, value):
+        ident = thread.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            # bucket counts, +Inf, sum, count
+            shard = self._shards[ident] = [0] * (len(self._buckets) + 3)
+        shard[bisect.bisect_left(self._buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def snapshot(self):
+        """
+        :return: tuple (cumulative bucket counts including +Inf, sum, count)
+        """
+        total = [0] * (len(self._buckets) + 3)
+        for shard in self._shards.values():
+            for index, value in enumerate(shard):
+                total[index] += value
+        cumulative = []
+        running = 0
+        for count in total[:-2]:
+            running += count
+            cumulative.append(running)
+        return cumulative, total[-2], total[-1]
+
+    @property
+    def buckets(self): return self._buckets
+
+
+class Metric:
+    """
+    Named metric with optional labels
+    """
+
+    def __init__(self, name, description, kind, labels=(), buckets=None):
+        self._name = name
+        self._description = description
+        self._kind = kind
+        self._labels = tuple(labels)
+        self._buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = Counter() if self._kind == 'counter' else Histogram(self._buckets or LATENCY_BUCKETS)
+                    self._children[values] = child
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(values, None)
+
+    # unlabeled metrics
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _format_labels(self, values, extra=None):
+        pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                 for name, value in zip(self._labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self._name, self._description),
+                 '# TYPE %s %s' % (self._name, self._kind)]
+        for values, child in sorted(self._children.items()):
+            if self._kind == 'counter':
+                lines.append('%s%s %s' % (self._name, self._format_labels(values), child.value))
+            else:
+                (cumulative, total, count) = child.snapshot()
+                for bound, running in zip(list(child.buckets) + ['+Inf'], cumulative):
+                    lines.append('%s_bucket%s %d' % (self._name, self._format_labels(values, 'le="%s"' % bound),
+                                                     running))
+                lines.append('%s_sum%s %s' % (self._name, self._format_labels(values), repr(total)))
+                lines.append('%s_count%s %d' % (self._name, self._format_labels(values), count))
+        return '\n'.join(lines)
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics = []
+        self._names = {}
+
+    def _register(self, metric, name):
+        if name not in self._names:
+            self._names[name] = metric
+            self._metrics.append(metric)
+        return self._names[name]
+
+    def counter(self, name, description, labels=()):
+        return self._register(Metric(name, description, 'counter', labels), name)
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Metric(name, description, 'histogram', labels, buckets), name)
+
+    def render(self):
+        return ''.join(metric.render() + '\n' for metric in self._metrics)
+
+
+# registry shared by all modules
+metrics = MetricsRegistry()
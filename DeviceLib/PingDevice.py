@@ -12,12 +12,23 @@ import subprocess
 import re
 import socket
 import threading
-import requests
 import random
 import copy
+import math
+import collections
 
 from Device import *
 from ping import send_one_ping, receive_one_ping, do_one
+from IcmpEngine import IcmpEngine, icmp_socket, ping_once, cidr_hosts
+from Pipeline import TransitionPipeline
+from Resolver import Resolver
+from Registry import DeviceRegistry
+from Metrics import metrics
+
+_probes = metrics.counter('devicedaemon_ping_probes_total', 'Ping probes per device', ['device'])
+_failures = metrics.counter('devicedaemon_ping_failures_total', 'Failed ping probes per device', ['device'])
+_rtt = metrics.histogram('devicedaemon_ping_rtt_seconds', 'Ping round trip time per device', ['device'])
+_passive = metrics.counter('devicedaemon_ping_passive_total', 'Probes replaced by neighbour table entries', ['device'])
 
 class PingDevice(Device, threading.Thread):
 
@@ -31,12 +42,34 @@ class PingDevice(Device, threading.Thread):
         self._logger = logger
         self._socket_id = ( os.getpid() + self._number) & 0xFFFF
         self._socket = None
-        self._icmp = None
+        self._raw = True
+        self._sequence = 0
+        self._delay = None
         self._callback = None if 'callback' not in device else device['callback']
-        self._sleep = 1 if 'sleep' not in device else device['sleep']
-        self._psize = 64 if 'psize' not in device else device['psize']
-        self._timeout = 1 if 'timeout' not in device else device['timeout']
-        self._retry = 1 if 'retry' not in device else device['retry']
+        self._pipeline = None if 'pipeline' not in device else device['pipeline']
+        self._sleep = 1 if 'sleep' not in device else int(device['sleep'])
+        self._psize = 64 if 'psize' not in device else int(device['psize'])
+        self._timeout = 1 if 'timeout' not in device else int(device['timeout'])
+        self._retry = 1 if 'retry' not in device else int(device['retry'])
+        self._min_sleep = float(device['min_sleep']) if device.get('min_sleep') else self._sleep
+        self._max_sleep = float(device['max_sleep']) if device.get('max_sleep') else self._sleep
+        self._jitter = float(device['jitter']) / 100 if device.get('jitter') else 0
+        self._interval = self._sleep
+        # burst of confirmation probes before an online device is reported offline
+        self._confirm = int(device['confirm']) if device.get('confirm') else 0
+        self._confirm_interval = float(device['confirm_interval']) / 1000 if device.get('confirm_interval') else 0.2
+        # passive presence from the neighbour table
+        self._present = False
+        self._fresh = False
+        self._expire = 0
+        self._verified = 0
+        # ring buffers of the latest round trip times and probe results
+        window = int(device['stats_window']) if device.get('stats_window') else 100
+        self._rtts = collections.deque(maxlen=window)
+        self._results = collections.deque(maxlen=window)
+        # n of m hysteresis: report a transition if threshold of the last window probes disagree
+        self._threshold = int(device['threshold']) if device.get('threshold') else 1
+        self._votes = collections.deque(maxlen=max(int(device.get('window') or 1), self._threshold))
         self._shutdown = False
 
 # region check device ip/dns
@@ -66,25 +99,31 @@ class PingDevice(Device, threading.Thread):
 
         Device.__init__(self, self._logger, device)
 
+    def open(self):
+        """
+        Create the private ICMP socket used by the threaded ping
+        """
 # region socket initialization
-        if os.geteuid() == 0:
-            self._icmp = socket.getprotobyname("icmp")
-            try:
-                self._socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, self._icmp)
-            except socket.error, (errno, msg):
-                if errno == 1:
-                    # Operation not permitted
-                    msg += " - Note that ICMP messages can only be sent from processes"
-                    raise socket.error(msg)
-                raise # raise the original error
+        try:
+            (self._socket, self._raw) = icmp_socket()
+        except socket.error, e:
+            if os.geteuid() == 0:
+                raise
+            # no unprivileged ICMP sockets => fork suid ping
+            self._logger.debug("Ping %s for [%s] uses ping command: %s" % (self.name, self._key, e))
+            self._socket = None
 # endregion
 
     def run(self):
         self._logger.info("Ping %s for [%s] started ..." % (self.name, self._key))
+        try:
+            time.sleep(self.offset)
+        except:
+            self._shutdown = True
         while not self._shutdown:
             self.check(self._callback)
             try:
-                time.sleep(self._sleep)
+                time.sleep(self.interval())
             except:
                 break
         self.done()
@@ -101,17 +140,32 @@ class PingDevice(Device, threading.Thread):
 
     def _ping(self):
 
-        if os.geteuid() == 0:
+        self._delay = None
+
+        if self._socket is not None and self._raw:
             # running as root => use python ICMP            '''
             try:
                 send_one_ping(self._socket, self.ip, self._socket_id, self._psize)
                 delay = receive_one_ping(self._socket, self._socket_id, self._timeout)
                 if delay is not None:
+                    self._delay = delay
                     return True
                 else:
                     return False
             except socket.error as e:
                 return None
+        elif self._socket is not None:
+            # unprivileged ICMP datagram socket
+            try:
+                for attempt in range(self._retry):
+                    self._sequence = (self._sequence + 1) & 0xFFFF
+                    self._delay = ping_once(self._socket, False, self._socket_id, self._sequence,
+                                            self.ip, self._psize, self._timeout)
+                    if self._delay is not None:
+                        return True
+                return False
+            except socket.error as e:
+                return None
         else:
             # running suid ping as non-root user
             timeout = "-W" + str(self._timeout)
@@ -132,70 +186,477 @@ class PingDevice(Device, threading.Thread):
             self._logger.error("Missing ip address for device [%s]" % self.dns)
             return None
 
+        if self.skip():
+            return self._online
+
         result = self._ping()
+        for attempt in range(self.confirm if result is False else 0):
+            if self._shutdown:
+                break
+            time.sleep(self._confirm_interval)
+            result = self._ping()
+            if result is not False:
+                break
+        return self.process(result, self._delay)
+
+    def seen(self, present, fresh=False, expire=30):
+        """
+        Passive presence from the neighbour table
+        :param present: device has a complete neighbour entry
+        :param fresh: entry was added or changed since the last lookup
+        :param expire: seconds a successful probe is trusted while the entry persists
+        """
+        self._present = present
+        self._fresh = present and (fresh or self._fresh)
+        self._expire = expire
+
+    def skip(self):
+        """
+        Replace the next probe by the neighbour table: fresh entries count as
+        online, persisting entries only within expire seconds of the last
+        successful probe. Stale entries are checked with active probes.
+        :return: True, if the device was processed as online without probe
+        """
+        if not self._present:
+            return False
+        if not self._fresh and time.time() - self._verified >= self._expire:
+            return False
+        self._fresh = False
+        _passive.labels(self._key).inc()
+        self.process(True, passive=True)
+        return True
+
+    def _notify(self, event, previous):
+        if self._pipeline is not None:
+            self._pipeline.put(self, event, previous)
+        else:
+            Device.callback(self, event)
+
+    def _adapt(self, changed):
+        """
+        Adjust the probe interval between min_sleep and max_sleep: recently changed
+        devices are probed fast, stable online devices less often and offline
+        devices back off exponentially.
+        """
+        if changed:
+            self._interval = self._min_sleep
+        elif self._online:
+            self._interval = min(self._interval * 1.5, self._max_sleep)
+        else:
+            self._interval = min(self._interval * 2, self._max_sleep)
+
+    def _confirmed(self, result):
+        """
+        Debounce transitions: a result differing from the current state is
+        only accepted if it was seen threshold times within the window
+        """
+        if self._online is None:
+            return True
+        self._votes.append(result)
+        if result == self._online:
+            return True
+        if self._votes.count(result) >= self._threshold:
+            self._votes.clear()
+            return True
+        self._logger.debug('Ping device [%s] %s: %s unconfirmed (%d of %d)' %
+                           (self.ip, self.dns, "Online" if result else "Offline",
+                            self._votes.count(result), self._threshold))
+        return False
+
+    def interval(self):
+        """
+        Seconds until the next probe, including random jitter
+        """
+        if self._jitter:
+            return max(self._interval * random.uniform(1 - self._jitter, 1 + self._jitter), 0)
+        return self._interval
+
+    def process(self, result, delay=None, passive=False):
+        """
+        Update device status with the result of a ping
+        :param result: True/False for online/offline, None if the ping failed
+        :param delay: round trip time in seconds, if available
+        :param passive: result from the neighbour table instead of a probe
+        :return: True, if device is online
+        """
+        if not passive:
+            _probes.labels(self._key).inc()
+            if result is not True:
+                _failures.labels(self._key).inc()
+            else:
+                self._verified = time.time()
+            if delay is not None:
+                _rtt.labels(self._key).observe(delay)
+                self._rtts.append(delay)
 
         if result is not None:
 
+            if not passive:
+                self._results.append(result)
+
             self.update()
 
             self._logger.debug('Ping device [%s] %s: %s' % (self.ip, self.dns, "Online" if result else "Offline"))
 
+            self._adapt(result != self._online)
+
+            if not self._confirmed(result):
+                return self._online
+
+            # the state is updated before notifying: events snapshot it when published
+            previous = self._online
+            self._online = result
             if result is False:
                 # device offline
-                if (self._online is True) or (self._online is None and self._status is True):
-                        Device.callback(self, 'off')
-                self._online = False
+                if (previous is True) or (previous is None and self._status is True):
+                    self._notify('off', previous)
             else:
                 # device online
-                if (self._online is False) or (self._online is None and self._status is False):
-                    Device.callback(self, 'new')
-                self._online = True
+                if (previous is False) or (previous is None and self._status is False):
+                    self._notify('new', previous)
 
         return self._online
 
+    def state(self):
+        state = Device.state(self)
+        state['ip'] = self.ip
+        state['dns'] = self.dns
+        return state
+
+    def stats(self):
+        """
+        :return: dictionary with round trip times in milliseconds and loss in percent
+        """
+        rtts = sorted(self._rtts)
+        stats = {'probes': len(self._results), 'loss': self.loss,
+                 'rtt_min': None, 'rtt_avg': None, 'rtt_max': None, 'rtt_p95': None}
+        if rtts:
+            stats['rtt_min'] = round(rtts[0] * 1000, 3)
+            stats['rtt_avg'] = round(sum(rtts) / len(rtts) * 1000, 3)
+            stats['rtt_max'] = round(rtts[-1] * 1000, 3)
+            stats['rtt_p95'] = round(self._percentile(rtts, 95) * 1000, 3)
+        return stats
+
+    @staticmethod
+    def _percentile(values, percent):
+        # nearest rank of sorted values
+        return values[max(int(math.ceil(len(values) * percent / 100.0)) - 1, 0)]
+
     @property
-    def ip(self): return self._config['ip']
+    def rtt_min(self): return min(self._rtts) if self._rtts else None
 
     @property
-    def dns(self): return self._config['dns']
+    def rtt_avg(self): return sum(self._rtts) / len(self._rtts) if self._rtts else None
+
+    @property
+    def rtt_max(self): return max(self._rtts) if self._rtts else None
+
+    @property
+    def rtt_p95(self): return self._percentile(sorted(self._rtts), 95) if self._rtts else None
+
+    @property
+    def loss(self):
+        """
+        Percentage of failed probes in the statistics window
+        """
+        if not self._results:
+            return None
+        return 100.0 * self._results.count(False) / len(self._results)
+
+    @property
+    def sleep(self): return self._sleep
+
+    @property
+    def offset(self):
+        """
+        Random delay of the first probe to spread probes after startup
+        """
+        return random.uniform(0, self._sleep * self._jitter)
+
+    @property
+    def confirm(self):
+        """
+        Number of confirmation probes after a failed probe, only online devices are confirmed
+        """
+        return self._confirm if self._online else 0
+
+    @property
+    def confirm_interval(self): return self._confirm_interval
+
+    @property
+    def timeout(self): return self._timeout
+
+    @property
+    def retry(self): return self._retry
+
+    @property
+    def psize(self): return self._psize
+
+    @property
+    def ip(self): return self._config.get('ip')
+
+    @property
+    def dns(self): return self._config.get('dns')
 
 
 class PingDiscoverDevice():
 
+    _probe_options = ['psize', 'timeout', 'sleep', 'min_sleep', 'max_sleep', 'jitter', 'online', 'stats_window',
+                      'threshold', 'window', 'confirm', 'confirm_interval']
+
     def __init__(self, logger, options, devices):
 
         self._logger = logger
         self._options = options
         self._devices = {}
+        self._pings = {}
+        self._restored = {}
         self._threads = []
+        self._engine = None
+        self._swept = {}    # address -> device found by subnet sweeps
+        self._pipeline = None
+        self._resolver = Resolver(self._logger, options, self._resolved)
+        self._loop = None
+        self._registry = DeviceRegistry.wrap(devices)
+
+        if options.get('batch'):
+            self._pipeline = TransitionPipeline(self._logger, options)
 
         for device in options['devices']:
+            self._configure(device)
+
+    def _configure(self, device):
+
+        key = self._registry.lookup(device)
+        if key is not None:
+            self._devices[device] = self._registry.config(key)
+        else:
+            self._devices[device] = {}
+            self._devices[device]['key'] = device
+            self._devices[device]['dns'] = device
+
+        for key in self._probe_options + ['callback']:
+            if key in self._options:
+                if key not in self._devices[device]:
+                    self._devices[device][key] = self._options[key]
+
+        if self._pipeline is not None:
+            self._devices[device]['pipeline'] = self._pipeline
+
+    def _start(self, device):
 
-            if device in devices:
-                self._devices[device] = copy.deepcopy(devices[device])
+        try:
+            thread = PingDevice(self._logger, self._devices[device])
+            if device in self._restored:
+                thread.restore(self._restored[device])
+            self._pings[device] = thread
+            if self._options.get('multiplex') and self._engine is not None:
+                self._engine.register(thread)
             else:
-                self._devices[device] = {}
-                self._devices[device]['key'] = device
-                self._devices[device]['dns'] = device
+                thread.open()
+                thread.start()
+                self._threads.append(thread)
+        except ValueError, e:
+            self._logger.error(e.message)
+
+    def _resolved(self, config):
+        """
+        Called by the resolver thread when the name of a device without probe was resolved
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._start_resolved, config)
+        else:
+            self._start_resolved(config)
+
+    def _start_resolved(self, config):
+        for device in self._devices.keys():
+            if self._devices[device] is config and device not in self._pings:
+                self._logger.info("Ping: Starting [%s] with resolved address %s" % (device, config['ip']))
+                self._start(device)
+
+    def _stop(self, device):
+
+        if device in self._devices:
+            self._resolver.unwatch(self._devices[device])
+        thread = self._pings.pop(device, None)
+        if thread is None:
+            return
+        if self._options.get('multiplex') and self._engine is not None:
+            self._engine.unregister(thread)
+        else:
+            thread.shutdown()
+            self._threads.remove(thread)
 
-            for key in ['psize', 'timeout', 'sleep', 'callback', 'online']:
-                if key in self._options:
-                    if key not in self._devices[device]:
-                        self._devices[device][key] = self._options[key]
+    def listen(self, loop=None):
+        """
+        Start pinging the devices
+        :param loop: optional event loop hosting the multiplexed icmp engine
+        """
+        self._loop = loop
 
-    def listen(self):
+        # addresses from a restored checkpoint save the lookups
+        for device in self._devices:
+            if device in self._restored:
+                config = self._devices[device]
+                if 'dns' in config and 'ip' not in config:
+                    self._resolver.seed('ip', config['dns'], self._restored[device].get('ip'))
+                elif 'ip' in config and 'dns' not in config:
+                    self._resolver.seed('dns', config['ip'], self._restored[device].get('dns'))
+
+        # resolve all device names concurrently before the probes start
+        self._resolver.resolve_all(self._devices.values())
+        self._resolver.start()
+
+        if self._options.get('multiplex') or self._networks():
+            try:
+                self._engine = IcmpEngine(self._logger, self._options)
+                self._engine.open()
+            except socket.error, e:
+                self._logger.error("Icmp engine not available (%s). Using ping threads!" % e)
+                self._engine = None
 
         for device in self._devices:
+            self._start(device)
 
+        if self._networks():
+            self._start_sweep()
+
+        if self._engine is not None:
+            if loop is not None:
+                self._engine.attach(loop)
+            else:
+                self._engine.start()
+
+        if self._pipeline is not None:
+            if loop is not None:
+                self._pipeline.attach(loop)
+            else:
+                self._pipeline.start()
+
+    def _networks(self):
+        """
+        :return: list of the networks to sweep, comma separated in the configuration file
+        """
+        networks = self._options.get('sweep') or []
+        if isinstance(networks, basestring):
+            networks = networks.split(',')
+        return [network.strip() for network in networks if network.strip()]
+
+    def _start_sweep(self):
+        """
+        Periodically probe all hosts of the configured networks with the icmp engine
+        """
+        if self._engine is None:
+            self._logger.error("Ping: Subnet sweep requires the icmp engine!")
+            return
+        addresses = []
+        for network in self._networks():
             try:
-                thread = PingDevice(self._logger, self._devices[device])
-                thread.start()
-                self._threads.append(thread)
+                addresses.extend(cidr_hosts(network))
             except ValueError, e:
-                self._logger.error(e.message)
+                self._logger.error("Ping: %s" % e)
+        try:
+            self._engine.sweep(addresses, self._sweep_reply, self._sweep_done, int(self._options['sweep_rate']),
+                               int(self._options['timeout']), int(self._options['sweep_interval']))
+        except ValueError, e:
+            self._logger.error("Ping: %s" % e)
+            return
+        self._logger.info("Ping: Sweeping %d addresses every %s seconds" %
+                          (len(addresses), self._options['sweep_interval']))
+
+    def _sweep_reply(self, address, delay):
+
+        if address in self._watched():
+            return
+        device = self._swept.get(address)
+        if device is None:
+            config = {'key': address, 'ip': address, 'dns': address, 'online': False}
+            for key in self._probe_options + ['callback']:
+                if key in self._options and key not in config:
+                    config[key] = self._options[key]
+            if self._pipeline is not None:
+                config['pipeline'] = self._pipeline
+            device = self._swept[address] = PingDevice(self._logger, config)
+        device.process(True, delay)
+
+    def _sweep_done(self, alive):
+
+        for address, device in self._swept.items():
+            if address not in alive:
+                device.process(False)
+
+    def _watched(self):
+        return set(ping.ip for ping in self._pings.values())
+
+    def reload(self, options, changed):
+        """
+        Apply a new configuration: only added, removed and changed devices are restarted
+        :param options: new options of the ping section
+        :param changed: keys of added, removed or changed device configurations
+        """
+        for key in ['multiplex', 'batch', 'sweep', 'sweep_rate', 'sweep_interval']:
+            if options.get(key) != self._options.get(key):
+                self._logger.warn("Ping: Changed option [%s] requires a restart!" % key)
+
+        restart = [key for key in self._probe_options if options.get(key) != self._options.get(key)]
+        for key in self._probe_options + ['devices']:
+            if key in options:
+                self._options[key] = options[key]
+
+        devices = set(self._options['devices'])
+        for device in self._devices.keys():
+            if restart or device not in devices or self._registry.lookup(device) in changed \
+                    or (device in changed and device not in self._registry):
+                self._logger.info("Ping: Stopping [%s]" % device)
+                if device in devices and device in self._pings:
+                    # restarted probes continue with the current state
+                    self._restored[device] = self._pings[device].state()
+                self._stop(device)
+                del self._devices[device]
+
+        added = [device for device in self._options['devices'] if device not in self._devices]
+        for device in added:
+            self._configure(device)
+        self._resolver.resolve_all([self._devices[device] for device in added])
+        for device in added:
+            self._logger.info("Ping: Starting [%s]" % device)
+            self._start(device)
+
+    def state(self):
+        return dict((device, ping.state()) for device, ping in self._pings.items())
+
+    @property
+    def pings(self): return self._pings.values()
+
+    @property
+    def swept(self): return self._swept.values()
 
+    def stats(self, device=None):
+        """
+        :param device: device name or any identifier, None for all devices
+        :return: dictionary of round trip and loss statistics by device
+        """
+        if device is None:
+            return dict((name, ping.stats()) for name, ping in self._pings.items())
+        if device not in self._pings:
+            key = self._registry.lookup(device)
+            device = next((name for name, ping in self._pings.items() if ping.key == key), None)
+            if key is None or device is None:
+                return {}
+        return {device: self._pings[device].stats()}
+
+    def restore(self, state):
+        """
+        Restore online state and addresses of a checkpoint before listen()
+        """
+        self._restored = state
 
     def shutdown(self):
+        self._resolver.shutdown()
+        if self._pipeline is not None:
+            self._pipeline.shutdown()
+        if self._engine is not None:
+            self._engine.shutdown()
         for thread in self._threads:
             thread.shutdown()
 
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+    collect device state transitions and dispatch them in batches
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import threading
+import collections
+import logging
+import time
+
+from Device import Device
+
+Transition = collections.namedtuple('Transition', ['device', 'event', 'previous', 'timestamp'])
+
+
+class TransitionPipeline(threading.Thread):
+    """
+    Probes put their state transitions into the pipeline instead of calling
+    the device callbacks. Once per interval all pending transitions are
+    coalesced per device and handed over to the 'batch' callback in a single
+    call. Without a 'batch' callback the device callbacks are called one by one.
+    """
+
+    _state = {'new': True, 'off': False}
+
+    def __init__(self, logger, options):
+
+        threading.Thread.__init__(self)
+        assert isinstance(logger, logging.Logger)
+        self._logger = logger
+        self._callback = options.get('callback')
+        self._interval = options['batch']
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._shutdown = False
+
+    def put(self, device, event, previous):
+        """
+        Queue a transition: called from the probing threads
+        :param previous: online state of the device before the transition
+        """
+        with self._lock:
+            if device.key in self._pending:
+                previous = self._pending.pop(device.key).previous
+                if previous is not None and previous == self._state.get(event):
+                    # device flapped back within the interval
+                    return
+            self._pending[device.key] = Transition(device, event, previous, time.time())
+
+    def dispatch(self):
+
+        with self._lock:
+            if not self._pending:
+                return
+            transitions = self._pending.values()
+            self._pending = collections.OrderedDict()
+
+        if self._callback and 'batch' in self._callback:
+            try:
+                self._callback['batch'](transitions)
+            except:
+                self._logger.exception("Batch callback throwed exception!")
+        else:
+            for transition in transitions:
+                Device.callback(transition.device, transition.event)
+
+    def run(self):
+        self._logger.info("Transition pipeline started with interval of %d seconds ..." % self._interval)
+        while not self._shutdown:
+            time.sleep(self._interval)
+            self.dispatch()
+        self._logger.info("Transition pipeline stopped!")
+
+    def attach(self, loop):
+        """
+        Dispatch from the event loop instead of an own thread
+        """
+        self._loop = loop
+        self._loop.call_later(self._interval, self._loop_tick)
+
+    def _loop_tick(self):
+        self.dispatch()
+        if not self._shutdown:
+            self._loop.call_later(self._interval, self._loop_tick)
+
+    def shutdown(self):
+        self._shutdown = True
+
+    @property
+    def pending(self): return len(self._pending)
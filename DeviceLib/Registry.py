@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+    shared device registry indexed by all device identifiers
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import threading
+
+
+class DeviceConfig(object):
+    """
+    Per subsystem view of a registered device configuration. Reads fall
+    back to the shared configuration, subsystem settings (callbacks, probe
+    options) are stored locally. Indexed identifiers (e.g. a resolved ip
+    address) are written through to the registry.
+    """
+
+    def __init__(self, registry, key, local=None):
+        self._registry = registry
+        self._key = key
+        self._local = {} if local is None else dict(local)
+
+    @property
+    def _shared(self):
+        # empty for a device removed by a reload while its probe stops
+        return dict.get(self._registry, self._key, {})
+
+    def __getitem__(self, name):
+        if name in self._local:
+            return self._local[name]
+        return self._shared[name]
+
+    def __setitem__(self, name, value):
+        if name in DeviceRegistry.fields:
+            self._registry.set(self._key, name, value)
+        else:
+            self._local[name] = value
+
+    def __contains__(self, name):
+        return name in self._local or name in self._shared
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        return list(set(self._shared.keys()) | set(self._local.keys()))
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class DeviceRegistry(dict):
+    """
+    Device configurations by key with a secondary index over serial,
+    bluetooth and wlan address, ip address and dns name. Lookups by any
+    identifier are dictionary lookups. Shared by all discover modules.
+    """
+
+    fields = ['serial', 'bt', 'wlan', 'ip', 'dns']
+
+    @staticmethod
+    def wrap(devices):
+        """
+        :return: registry for a plain dictionary of device configurations
+        """
+        if isinstance(devices, DeviceRegistry):
+            return devices
+        return DeviceRegistry(devices)
+
+    @staticmethod
+    def _normalize(value):
+        return ('%s' % value).lower()
+
+    def __init__(self, devices=None):
+        dict.__init__(self)
+        self._index = {}        # (field, value) -> key
+        self._any = {}          # value -> key
+        self._values = {}       # key -> indexed (field, value) pairs
+        self._lock = threading.RLock()
+        if devices:
+            for key in devices:
+                self[key] = devices[key]
+
+    def __setitem__(self, key, device):
+        with self._lock:
+            if key in self:
+                self._unindex(key)
+            dict.__setitem__(self, key, device)
+            self._reindex(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._unindex(key)
+            dict.__delitem__(self, key)
+
+    def _reindex(self, key):
+        device = dict.__getitem__(self, key)
+        values = [('key', self._normalize(key))]
+        for field in self.fields:
+            if device.get(field):
+                values.append((field, self._normalize(device[field])))
+        for field, value in values:
+            self._index[(field, value)] = key
+            self._any.setdefault(value, key)
+        self._values[key] = values
+
+    def _unindex(self, key):
+        for field, value in self._values.pop(key, []):
+            if self._index.get((field, value)) == key:
+                del self._index[(field, value)]
+            if self._any.get(value) == key:
+                del self._any[value]
+
+    def set(self, key, field, value):
+        """
+        Update an identifier of a registered device
+        """
+        with self._lock:
+            self._unindex(key)
+            dict.__getitem__(self, key)[field] = value
+            self._reindex(key)
+
+    def reload(self, devices):
+        """
+        Replace the device configurations. Resolved addresses of unchanged
+        devices are kept.
+        :return: set of added, removed and changed device keys
+        """
+        changed = set()
+        with self._lock:
+            for key in [key for key in self if key not in devices]:
+                del self[key]
+                changed.add(key)
+            for key in devices:
+                if key in self:
+                    current = dict.__getitem__(self, key)
+                    configured = dict((name, current[name]) for name in devices[key] if name in current)
+                    removed = set(current) - set(devices[key]) - set(['ip', 'dns'])
+                    if configured == devices[key] and not removed:
+                        continue
+                self[key] = devices[key]
+                changed.add(key)
+        return changed
+
+    def find(self, field, value):
+        """
+        :return: device key for an identifier of the given field or None
+        """
+        if value is None:
+            return None
+        return self._index.get((field, self._normalize(value)))
+
+    def lookup(self, value):
+        """
+        :return: device key for any known identifier or None
+        """
+        if value is None:
+            return None
+        return self._any.get(self._normalize(value))
+
+    def config(self, key, local=None):
+        """
+        :return: subsystem view of the device configuration
+        """
+        return DeviceConfig(self, key, local)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+    concurrent name resolution with ttl cache for ping devices
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import socket
+import threading
+import logging
+import time
+
+from multiprocessing.pool import ThreadPool
+
+
+class Resolver(threading.Thread):
+    """
+    Resolve host names and addresses in a pool of worker threads. Results
+    are cached for 'dns_ttl' seconds, failures for 'dns_negative_ttl'
+    seconds. Watched devices are re-resolved in the background, so address
+    changes (DHCP) are picked up without a restart. The resolved function
+    is called for devices whose name could not be resolved before.
+    """
+
+    def __init__(self, logger, options, resolved=None):
+
+        threading.Thread.__init__(self)
+        assert isinstance(logger, logging.Logger)
+        self._logger = logger
+        self._ttl = int(options.get('dns_ttl', 300))
+        self._negative_ttl = int(options.get('dns_negative_ttl', 60))
+        self._workers = max(int(options.get('dns_workers', 8)), 1)
+        self._cache = {}        # (kind, name) -> (value, expires)
+        self._watched = []      # device config dicts resolved by dns name
+        self._resolved = resolved
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def _lookup(self, kind, name):
+
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get((kind, name))
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        try:
+            if kind == 'ip':
+                value = socket.gethostbyname(name)
+            else:
+                value = socket.gethostbyaddr(name)[0]
+        except socket.error:
+            value = None
+
+        with self._lock:
+            self._cache[(kind, name)] = (value, now + (self._ttl if value is not None else self._negative_ttl))
+
+        return value
+
+    def seed(self, kind, name, value):
+        """
+        Add a known result, e.g. from a saved checkpoint
+        :param kind: 'ip' for host names, 'dns' for addresses
+        """
+        if name is not None and value is not None:
+            with self._lock:
+                self._cache[(kind, name)] = (value, time.time() + self._ttl)
+
+    def resolve(self, name):
+        """
+        :return: ip address of a host name or None
+        """
+        return self._lookup('ip', name)
+
+    def reverse(self, address):
+        """
+        :return: host name of an ip address or None
+        """
+        return self._lookup('dns', address)
+
+    def _complete(self, device):
+        if 'dns' in device and 'ip' not in device:
+            device['ip'] = self.resolve(device['dns'])
+            with self._lock:
+                self._watched.append(device)
+        elif 'ip' in device and 'dns' not in device:
+            device['dns'] = self.reverse(device['ip'])
+        return device
+
+    def unwatch(self, device):
+        """
+        Stop re-resolving a removed or changed device configuration
+        """
+        with self._lock:
+            self._watched = [watched for watched in self._watched if watched is not device]
+
+    def resolve_all(self, devices):
+        """
+        Add missing 'ip' or 'dns' entries to the device configurations concurrently
+        :param devices: list of device config dicts
+        """
+        if not devices:
+            return devices
+        pool = ThreadPool(min(self._workers, len(devices)))
+        try:
+            return pool.map(self._complete, devices)
+        finally:
+            pool.close()
+            pool.join()
+
+    def refresh(self):
+        """
+        Re-resolve watched devices with expired cache entries
+        """
+        now = time.time()
+        with self._lock:
+            expired = [device for device in self._watched
+                       if self._cache.get(('ip', device['dns']), (None, 0))[1] <= now]
+        for device in expired:
+            address = self.resolve(device['dns'])
+            if address is not None and address != device['ip']:
+                previous = device['ip']
+                self._logger.info("Address of [%s] changed from %s to %s" % (device['dns'], previous, address))
+                device['ip'] = address
+                if previous is None and self._resolved is not None:
+                    self._resolved(device)
+
+    def run(self):
+        self._logger.info("Resolver started with ttl of %d seconds ..." % self._ttl)
+        while not self._shutdown:
+            try:
+                self.refresh()
+            except:
+                self._logger.exception("Resolver refresh failed!")
+            for second in range(max(min(self._ttl, self._negative_ttl), 1)):
+                if self._shutdown:
+                    break
+                time.sleep(1)
+        self._logger.info("Resolver stopped!")
+
+    def shutdown(self):
+        self._shutdown = True
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+    arp table discovery with a /proc/net/arp fixture
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import os
+import sys
+import shutil
+import tempfile
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DeviceLib'))
+
+from ArpDevice import ArpDiscoverDevice
+
+_fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'arp')
+
+
+class Ping:
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.seen_with = None
+
+    def seen(self, present, fresh, expire):
+        self.seen_with = (present, fresh, expire)
+
+
+class Pings:
+
+    def __init__(self, *addresses):
+        self.pings = [Ping(address) for address in addresses]
+
+
+class ArpDiscoverDeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'arp')
+        shutil.copy(_fixture, self._path)
+        self._pings = Pings('192.168.1.1', '192.168.1.2', '192.168.1.3', '192.168.1.9')
+        self._arp = ArpDiscoverDevice(logging.getLogger(), {'path': self._path, 'interval': 10, 'expire': 30},
+                                      self._pings)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _seen(self):
+        return dict((ping.ip, ping.seen_with) for ping in self._pings.pings)
+
+    def _replace(self, old, new):
+        with open(self._path) as table:
+            content = table.read()
+        with open(self._path, 'w') as table:
+            table.write(content.replace(old, new))
+
+    def test_read_complete_entries(self):
+        self.assertEqual(self._arp.read(), {'192.168.1.1': 'aa:bb:cc:dd:ee:01',
+                                            '192.168.1.3': 'aa:bb:cc:dd:ee:03',
+                                            '192.168.1.4': 'aa:bb:cc:dd:ee:04'})
+
+    def test_read_missing_table(self):
+        os.remove(self._path)
+        self.assertEqual(self._arp.read(), {})
+
+    def test_first_check_marks_nothing_fresh(self):
+        self.assertEqual(self._arp.check(), 2)
+        self.assertEqual(self._seen(), {'192.168.1.1': (True, False, 30),
+                                        '192.168.1.2': (False, False, 30),
+                                        '192.168.1.3': (True, False, 30),
+                                        '192.168.1.9': (False, False, 30)})
+
+    def test_changed_entries_are_fresh(self):
+        self._arp.check()
+        self._replace('AA:BB:CC:DD:EE:03', 'aa:bb:cc:dd:ee:33')
+        self._replace('192.168.1.4 ', '192.168.1.9 ')
+        self._arp.check()
+        self.assertEqual(self._seen(), {'192.168.1.1': (True, False, 30),
+                                        '192.168.1.2': (False, False, 30),
+                                        '192.168.1.3': (True, True, 30),
+                                        '192.168.1.9': (True, True, 30)})
+
+    def test_removed_entries_are_absent(self):
+        self._arp.check()
+        self._replace('192.168.1.1 ', '192.168.1.8 ')
+        self._arp.check()
+        self.assertEqual(self._seen()['192.168.1.1'], (False, False, 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+    coalescing of device state transitions
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DeviceLib'))
+
+from Device import Device
+from Pipeline import TransitionPipeline
+from PingDevice import PingDevice
+
+
+class TransitionPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self._batches = []
+        self._pipeline = TransitionPipeline(logging.getLogger(), {'batch': 1,
+                                                                  'callback': {'batch': self._batches.append}})
+        self._device = Device(logging.getLogger(), {'key': 'a'})
+
+    def _dispatched(self):
+        self._pipeline.dispatch()
+        return [[(t.device.key, t.event, t.previous) for t in batch] for batch in self._batches]
+
+    def test_single_transitions(self):
+        other = Device(logging.getLogger(), {'key': 'b'})
+        self._pipeline.put(self._device, 'off', True)
+        self._pipeline.put(other, 'new', None)
+        self.assertEqual(self._pipeline.pending, 2)
+        self.assertEqual(self._dispatched(), [[('a', 'off', True), ('b', 'new', None)]])
+        self.assertEqual(self._pipeline.pending, 0)
+
+    def test_flap_within_interval(self):
+        self._pipeline.put(self._device, 'off', True)
+        self._pipeline.put(self._device, 'new', False)
+        self.assertEqual(self._dispatched(), [])
+
+    def test_flap_and_transition_within_interval(self):
+        self._pipeline.put(self._device, 'off', True)
+        self._pipeline.put(self._device, 'new', False)
+        self._pipeline.put(self._device, 'off', True)
+        self.assertEqual(self._dispatched(), [[('a', 'off', True)]])
+
+    def test_first_state_is_kept(self):
+        self._pipeline.put(self._device, 'new', None)
+        self._pipeline.put(self._device, 'off', True)
+        self.assertEqual(self._dispatched(), [[('a', 'off', None)]])
+
+    def test_device_callbacks_without_batch(self):
+        events = []
+        device = Device(logging.getLogger(), {'key': 'a', 'callback': {'off': lambda d: events.append(d.key)}})
+        pipeline = TransitionPipeline(logging.getLogger(), {'batch': 1, 'callback': {}})
+        pipeline.put(device, 'off', True)
+        pipeline.dispatch()
+        self.assertEqual(events, ['a'])
+
+    def test_ping_device_previous_state(self):
+        device = PingDevice(logging.getLogger(), {'key': 'a', 'ip': '127.0.0.1', 'dns': 'localhost',
+                                                   'online': False, 'pipeline': self._pipeline})
+        for result in [True, False, True, False]:
+            device.process(result)
+        self.assertEqual(self._dispatched(), [[('a', 'off', None)]])
+        for result in [True, False]:
+            device.process(result)
+        self.assertEqual(self._pipeline.pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+    configuration reload of the device registry and the ping devices
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DeviceLib'))
+
+from Registry import DeviceRegistry
+from PingDevice import PingDiscoverDevice
+
+
+class DeviceRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self._registry = DeviceRegistry({'a': {'key': 'a', 'dns': 'host-a', 'serial': 'S1'},
+                                         'b': {'key': 'b', 'ip': '10.0.0.2'}})
+        # resolved by the resolver
+        self._registry.config('a')['ip'] = '10.0.0.1'
+
+    def test_lookup(self):
+        self.assertEqual(self._registry.lookup('10.0.0.1'), 'a')
+        self.assertEqual(self._registry.lookup('HOST-A'), 'a')
+        self.assertEqual(self._registry.find('serial', 's1'), 'a')
+        self.assertEqual(self._registry.lookup('unknown'), None)
+
+    def test_reload_unchanged(self):
+        changed = self._registry.reload({'a': {'key': 'a', 'dns': 'host-a', 'serial': 'S1'},
+                                         'b': {'key': 'b', 'ip': '10.0.0.2'}})
+        self.assertEqual(changed, set())
+        self.assertEqual(self._registry['a']['ip'], '10.0.0.1')
+
+    def test_reload_changes(self):
+        changed = self._registry.reload({'a': {'key': 'a', 'dns': 'host-a', 'serial': 'S2'},
+                                         'c': {'key': 'c', 'ip': '10.0.0.3'}})
+        self.assertEqual(changed, set(['a', 'b', 'c']))
+        self.assertEqual(self._registry.find('serial', 'S2'), 'a')
+        self.assertEqual(self._registry.find('serial', 'S1'), None)
+        self.assertEqual(self._registry.lookup('10.0.0.2'), None)
+        self.assertEqual(self._registry.lookup('10.0.0.3'), 'c')
+
+    def test_config_of_removed_device(self):
+        config = self._registry.config('b')
+        self._registry.reload({'a': {'key': 'a', 'dns': 'host-a', 'serial': 'S1'}})
+        self.assertEqual(config.get('ip'), None)
+        self.assertFalse('ip' in config)
+
+
+class Engine:
+    """
+    Registered devices of the multiplexed icmp engine, without probing
+    """
+
+    def __init__(self):
+        self.devices = {}
+
+    def register(self, device):
+        self.devices[device.key] = device
+
+    def unregister(self, device):
+        if self.devices.get(device.key) is device:
+            del self.devices[device.key]
+
+
+class PingDiscoverDeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self._registry = DeviceRegistry({'a': {'key': 'a', 'ip': '127.0.0.1'},
+                                         'b': {'key': 'b', 'ip': '127.0.0.2', 'dns': 'host-b'}})
+        self._ping = PingDiscoverDevice(logging.getLogger(), self._options(['a', 'b']), self._registry)
+        self._ping._engine = Engine()
+        for device in ['a', 'b']:
+            self._ping._start(device)
+        # resolved by the resolver
+        self._registry.config('a')['dns'] = 'host-a'
+
+    def _options(self, devices):
+        return {'devices': devices, 'multiplex': True, 'sleep': 10, 'timeout': 1, 'dns_workers': 1}
+
+    def _reload(self, devices, options=None):
+        changed = self._registry.reload(devices)
+        self._ping.reload(options or self._options(sorted(devices)), changed)
+
+    def test_reload_unchanged(self):
+        probes = dict((ping.key, ping) for ping in self._ping.pings)
+        self._reload({'a': {'key': 'a', 'ip': '127.0.0.1'}, 'b': {'key': 'b', 'ip': '127.0.0.2', 'dns': 'host-b'}})
+        self.assertEqual(dict((ping.key, ping) for ping in self._ping.pings), probes)
+        self.assertEqual(self._registry['a']['dns'], 'host-a')
+
+    def test_reload_changed_address(self):
+        probe = self._ping._pings['a']
+        probe.process(True)
+        self._reload({'a': {'key': 'a', 'ip': '127.0.0.3'}, 'b': {'key': 'b', 'ip': '127.0.0.2', 'dns': 'host-b'}})
+        restarted = self._ping._pings['a']
+        self.assertFalse(restarted is probe)
+        self.assertEqual(restarted.ip, '127.0.0.3')
+        # the restarted probe continues with the state of the previous one
+        self.assertEqual(restarted.online, True)
+        self.assertTrue(self._ping._engine.devices['a'] is restarted)
+        # the stopped probe reads the new configuration without the resolved name
+        self.assertEqual(probe.state()['ip'], '127.0.0.3')
+
+    def test_reload_added_and_removed(self):
+        probe = self._ping._pings['b']
+        self._reload({'a': {'key': 'a', 'ip': '127.0.0.1'}, 'c': {'key': 'c', 'ip': '127.0.0.4'}})
+        self.assertEqual(sorted(self._ping._pings), ['a', 'c'])
+        self.assertEqual(sorted(self._ping._engine.devices), ['a', 'c'])
+        self.assertEqual(probe.state()['ip'], None)
+
+    def test_reload_probe_options(self):
+        probe = self._ping._pings['a']
+        options = self._options(['a', 'b'])
+        options['sleep'] = 20
+        self._reload({'a': {'key': 'a', 'ip': '127.0.0.1'}, 'b': {'key': 'b', 'ip': '127.0.0.2', 'dns': 'host-b'}},
+                     options)
+        self.assertFalse(self._ping._pings['a'] is probe)
+        self.assertEqual(self._ping._pings['a'].sleep, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
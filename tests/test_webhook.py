@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+    webhook event sink against a local http server
+
+"""
+__version__ = "1.0"
+__author__ = 'bst'
+
+import os
+import sys
+import json
+import threading
+import logging
+import unittest
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DeviceLib'))
+
+from EventBus import Event, WebhookSink
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.server.posts.append(json.loads(body))
+        status = self.server.responses.pop(0) if self.server.responses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        return
+
+
+class WebhookSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = HTTPServer(('127.0.0.1', 0), WebhookHandler)
+        self._server.posts = []
+        self._server.responses = []
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        url = 'http://127.0.0.1:%d/events' % self._server.server_address[1]
+        self._sink = WebhookSink(logging.getLogger(), {'webhook': url, 'webhook_window': 200, 'webhook_batch': 3,
+                                                       'webhook_retry': 2, 'webhook_backoff': 0.01, 'queue': 10})
+
+    def tearDown(self):
+        self._sink.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _events(self, count):
+        return [Event.create('ping.new', data={'number': number}) for number in range(count)]
+
+    def test_urls(self):
+        sink = WebhookSink(logging.getLogger(), {'webhook': 'http://a/x, http://b/y,'})
+        self.assertEqual(sink._urls, ['http://a/x', 'http://b/y'])
+        self.assertRaises(ValueError, WebhookSink, logging.getLogger(), {'webhook': ''})
+
+    def test_batch(self):
+        for event in self._events(4):
+            self._sink.put(event)
+        self._sink.deliver_all(self._sink.collect())
+        self._sink.deliver_all(self._sink.collect())
+        self.assertEqual([[event['data']['number'] for event in post] for post in self._server.posts],
+                         [[0, 1, 2], [3]])
+        self.assertEqual(self._server.posts[0][0]['event'], 'ping.new')
+
+    def test_retry(self):
+        self._server.responses = [500, 503]
+        self._sink.deliver_all(self._events(1))
+        self.assertEqual(len(self._server.posts), 3)
+
+    def test_retry_exhausted(self):
+        self._server.responses = [500, 500, 500]
+        self.assertRaises(IOError, self._sink.deliver_all, self._events(1))
+        self.assertEqual(len(self._server.posts), 3)
+
+    def test_rejected(self):
+        self._server.responses = [400]
+        self.assertRaises(IOError, self._sink.deliver_all, self._events(1))
+        self.assertEqual(len(self._server.posts), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()